@@ -0,0 +1,146 @@
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+# sha256 hex digest, also the only thing that ever becomes a path
+ID_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class Upload:
+    # Chunks are written straight to a temporary file and hashed on the way,
+    # so an upload holds one chunk in memory whatever the file size.
+    __slots__ = (
+        "store",
+        "id",
+        "name",
+        "size",
+        "room",
+        "to",
+        "path",
+        "file",
+        "hasher",
+        "received",
+    )
+
+    def __init__(self, store: "AttachmentStore", id, name, size, room, to):
+        self.store = store
+        self.id = id
+        self.name = name
+        self.size = size
+        self.room = room  # where it is posted once complete
+        self.to = to
+        fd, self.path = tempfile.mkstemp(dir=store.root, suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+        self.hasher = hashlib.sha256()
+        self.received = 0
+
+    @property
+    def done(self) -> bool:
+        return self.received == self.size
+
+    def write(self, offset, data: bytes):
+        # one TLS stream per upload, chunks can only arrive in order
+        if offset != self.received:
+            raise AttachmentError(f"Expected offset {self.received}, got {offset}")
+        if self.received + len(data) > self.size:
+            raise AttachmentError("More data than announced")
+        self.file.write(data)
+        self.hasher.update(data)
+        self.received += len(data)
+
+    def finish(self):
+        self.file.close()
+        if self.hasher.hexdigest() != self.id:
+            os.unlink(self.path)
+            raise AttachmentError("Checksum mismatch, upload discarded")
+        self.store.commit(self.path, self.id)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Download:
+    __slots__ = ("id", "view", "size", "sent", "acked")
+
+    def __init__(self, id, view):
+        self.id = id
+        self.view = view  # memoryview over the shared mapping
+        self.size = len(view)
+        self.sent = 0
+        self.acked = 0
+
+
+class AttachmentStore:
+    # Files are stored once under their content hash. Concurrent downloads of
+    # one file share a single read-only mapping, so it is read from disk once
+    # (through the page cache) however many members fetch it.
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.mapped = {}  # id -> [mmap, open downloads]
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, id) -> str:
+        if not ID_RE.fullmatch(id):
+            raise AttachmentError("Invalid attachment id")
+        return os.path.join(self.root, id)
+
+    def size(self, id) -> int | None:
+        try:
+            return os.path.getsize(self.path(id))
+        except OSError:
+            return None
+
+    def start_upload(self, id, name, size, room, to) -> Upload:
+        self.path(id)  # validates the id
+        if not 0 <= size <= self.max_size:
+            raise AttachmentError(f"Attachments are limited to {self.max_size} bytes")
+        return Upload(self, id, name, size, room, to)
+
+    def commit(self, part_path, id):
+        # the same content may finish twice, the first copy wins
+        if os.path.exists(self.path(id)):
+            os.unlink(part_path)
+        else:
+            os.replace(part_path, self.path(id))
+
+    def open(self, id) -> Download:
+        with self.lock:
+            entry = self.mapped.get(id)
+            if entry is None:
+                path = self.path(id)
+                if not os.path.exists(path):
+                    raise AttachmentError("Attachment not found")
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        # empty files cannot be mapped
+                        return Download(id, memoryview(b""))
+                    entry = self.mapped[id] = [
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                        0,
+                    ]
+            entry[1] += 1
+            return Download(id, memoryview(entry[0]))
+
+    def close(self, download: Download):
+        download.view.release()
+        with self.lock:
+            entry = self.mapped.get(download.id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.mapped[download.id]
+                entry[0].close()
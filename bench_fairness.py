@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import selectors
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from outbox import percentile_ms
+from utils import encode_frame, parse_header, decode_payload
+
+# One flooding client against many normal ones:
+#   python bench_fairness.py --clients 1000 --duration 10
+#   python bench_fairness.py --compare   # also without read budgets and quotas
+# Normal clients sit in rooms of --room-size and each asks for its member
+# list every --interval seconds; the flooder pipelines the same request as
+# fast as the server takes it. Reported are the normal clients' reply
+# latency, the flooder's rate and the server's fairness numbers. Runs the
+# real server.py, so server.crt/server.key must be in the working directory.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = "bench"
+REQUEST = {"type": "list", "data": {}}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    def __init__(self, port, username):
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        s = socket.create_connection(("127.0.0.1", port), timeout=60)
+        self.conn = context.wrap_socket(s, server_hostname="localhost")
+        self.username = username
+        self.buffer = bytearray()
+        self.sent_at = None  # outstanding request
+
+    def send(self, message):
+        self.conn.sendall(encode_frame(message, False))
+
+    def recv(self) -> dict:
+        while True:
+            message = self.parse()
+            if message is not None:
+                return message
+            data = self.conn.recv(65536)
+            if not data:
+                raise EOFError(f"{self.username}: server closed the connection")
+            self.buffer += data
+
+    def until(self, type) -> dict:
+        while True:
+            message = self.recv()
+            if message.get("type") == type:
+                return message
+
+    def parse(self) -> dict | None:
+        # one complete frame off the buffer, None until there is one
+        if len(self.buffer) < 4:
+            return None
+        length, compressed = parse_header(bytes(self.buffer[:4]))
+        if len(self.buffer) < 4 + length:
+            return None
+        payload = bytes(self.buffer[4 : 4 + length])
+        del self.buffer[: 4 + length]
+        return decode_payload(payload, compressed)
+
+    def login(self, room):
+        for type in ("register", "login"):
+            self.send(
+                {
+                    "type": type,
+                    "data": {"username": self.username, "password": PASSWORD},
+                }
+            )
+            self.until(type)
+        self.send({"type": "create", "data": {"room": room}})
+        self.until("create")  # already exists for all but the first member
+        self.send({"type": "enter", "data": {"room": room}})
+        if self.until("enter").get("status") != "ok":
+            raise RuntimeError(f"{self.username} could not enter {room}")
+
+
+def start_server(port, tmp, env_overrides):
+    env = dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        DATABASE_URL=f"sqlite+pysqlite:///{tmp}/bench.db",
+        SNAPSHOT_PATH=f"{tmp}/bench.snap",
+        HANDOFF_PATH=f"{tmp}/bench.sock",
+        ATTACHMENT_DIR=f"{tmp}/attachments",
+        **env_overrides,
+    )
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "server.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=5).close()
+            return proc
+        except ConnectionRefusedError:
+            if proc.poll() is not None:
+                raise RuntimeError("server exited, are server.crt/key here?")
+            time.sleep(0.01)
+
+
+def flood(client: Client, stop: threading.Event, counts):
+    def read():
+        try:
+            while True:
+                if client.recv().get("type") == "list_room":
+                    counts["replies"] += 1
+        except (OSError, EOFError):
+            pass
+
+    threading.Thread(target=read, daemon=True).start()
+    burst = encode_frame(REQUEST, False) * 64
+    try:
+        while not stop.is_set():
+            client.conn.sendall(burst)
+            counts["sent"] += 64
+    except OSError:
+        pass
+
+
+def poll(clients: list[Client], interval, deadline, latencies):
+    # one thread reads every normal client and sends each a request once its
+    # previous one is answered and its interval has passed
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.conn, selectors.EVENT_READ, client)
+    next_send = {
+        client: time.perf_counter() + interval * i / len(clients)
+        for i, client in enumerate(clients)
+    }
+    while time.perf_counter() < deadline:
+        now = time.perf_counter()
+        for client in clients:
+            if client.sent_at is None and next_send[client] <= now:
+                client.sent_at = now
+                next_send[client] = now + interval
+                client.send(REQUEST)
+        for key, _ in selector.select(timeout=0.005):
+            client = key.data
+            client.buffer += client.conn.recv(65536)
+            while client.conn.pending():
+                client.buffer += client.conn.recv(65536)
+            while (message := client.parse()) is not None:
+                if message.get("type") == "list_room" and client.sent_at:
+                    latencies.append(time.perf_counter() - client.sent_at)
+                    client.sent_at = None
+    selector.close()
+    return sum(1 for client in clients if client.sent_at is not None)
+
+
+def run(args, label, env_overrides) -> dict:
+    tmp = tempfile.mkdtemp()
+    port = free_port()
+    proc = start_server(port, tmp, env_overrides)
+    try:
+        with ThreadPoolExecutor(16) as pool:
+            clients = list(
+                pool.map(
+                    lambda i: Client(port, f"user{i}"),
+                    range(args.clients),
+                )
+            )
+            list(
+                pool.map(
+                    lambda i: clients[i].login(f"room{i // args.room_size}"),
+                    range(args.clients),
+                )
+            )
+        flooder = Client(port, "flooder")
+        flooder.login("flood")
+        for client in clients:
+            client.conn.settimeout(None)
+
+        stop = threading.Event()
+        counts = {"sent": 0, "replies": 0}
+        latencies = []
+        start = time.perf_counter()
+        if not args.no_flood:
+            threading.Thread(
+                target=flood, args=(flooder, stop, counts), daemon=True
+            ).start()
+        unanswered = poll(clients, args.interval, start + args.duration, latencies)
+        elapsed = time.perf_counter() - start
+        stop.set()
+
+        # a normal client asks, the flooder may have a long queue ahead
+        probe = clients[0]
+        probe.send({"type": "stats", "data": {}})
+        probe.conn.settimeout(30)
+        fairness = probe.until("stats")["data"]["fairness"]
+        return {
+            "label": label,
+            "latencies": sorted(latencies),
+            "unanswered": unanswered,
+            "flood_rate": counts["replies"] / elapsed,
+            "fairness": fairness,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def report(result):
+    samples = result["latencies"]
+    fairness = result["fairness"]
+    print(f"{result['label']}:")
+    print(
+        f"  normal clients   {len(samples)} replies"
+        f"   p50 {percentile_ms(samples, 0.5):8.2f} ms"
+        f"   p99 {percentile_ms(samples, 0.99):8.2f} ms"
+        f"   max {percentile_ms(samples, 1.0):8.2f} ms"
+        f"   {result['unanswered']} unanswered"
+    )
+    print(f"  flooder          {result['flood_rate']:.0f} replies/s")
+    print(
+        f"  server           jain {fairness.get('jain')}"
+        f" over {fairness.get('busy')} busy connections"
+        f"   max cpu share {fairness.get('max_cpu_share')}"
+        f"   throttled connections {fairness.get('throttled')}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inbound fairness benchmark")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="seconds between requests"
+    )
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--no-flood", action="store_true", help="normal load only")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="also run without read budgets and CPU quotas",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = [run(args, "fair scheduling", {})]
+    if args.compare:
+        results.append(
+            run(args, "no budgets or quotas", {"READ_BUDGET": "0", "CPU_QUOTA": "0"})
+        )
+    for result in results:
+        report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Startup benchmark for both entry points:
+#   python bench_startup.py            # import times + server time-to-first-accept
+#   python bench_startup.py --client   # also time-to-login-window (needs a display)
+# Time-to-first-accept runs the real server.py, so server.crt/server.key must
+# exist in the working directory (see "How to run it?").
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time(module, runs) -> list[float]:
+    code = (
+        "import sys, time; t = time.perf_counter(); "
+        f"sys.path.insert(0, {HERE!r}); import {module}; "
+        "print(time.perf_counter() - t)"
+    )
+    return [
+        float(subprocess.check_output([sys.executable, "-c", code]).decode())
+        for _ in range(runs)
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_first_accept(runs) -> list[float]:
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    results = []
+    for _ in range(runs):
+        tmp = tempfile.mkdtemp()
+        port = free_port()
+        env = dict(
+            os.environ,
+            HOST="127.0.0.1",
+            PORT=str(port),
+            DATABASE_URL=f"sqlite+pysqlite:///{tmp}/bench.db",
+            SNAPSHOT_PATH=f"{tmp}/bench.snap",
+            HANDOFF_PATH=f"{tmp}/bench.sock",
+        )
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "server.py")],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            # "accepted" means a TLS handshake completed
+            while True:
+                try:
+                    with socket.create_connection(("127.0.0.1", port), timeout=5) as s:
+                        with context.wrap_socket(s, server_hostname="localhost"):
+                            break
+                except (ConnectionRefusedError, ssl.SSLError):
+                    if proc.poll() is not None:
+                        raise RuntimeError("server exited, are server.crt/key here?")
+                    time.sleep(0.002)
+            results.append(time.perf_counter() - start)
+        finally:
+            proc.terminate()
+            proc.wait()
+    return results
+
+
+def client_first_window(runs) -> list[float]:
+    code = (
+        "import sys, time; t = time.perf_counter(); "
+        f"sys.path.insert(0, {HERE!r}); import client; "
+        "app = client.App(client.Dispatcher(), client.ServerHandler()); "
+        "app.update(); print(time.perf_counter() - t); app.destroy()"
+    )
+    env = dict(os.environ, HOST="127.0.0.1", PORT=str(free_port()))
+    return [
+        float(
+            subprocess.check_output([sys.executable, "-c", code], env=env)
+            .decode()
+            .split()[-1]
+        )
+        for _ in range(runs)
+    ]
+
+
+def report(name, samples):
+    ms = [sample * 1000 for sample in samples]
+    print(
+        f"{name:28s} median {statistics.median(ms):7.1f} ms"
+        f"   min {min(ms):7.1f} ms   max {max(ms):7.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--client", action="store_true")
+    args = parser.parse_args()
+
+    report("import server", import_time("server", args.runs))
+    report("import client", import_time("client", args.runs))
+    report("server first accept", server_first_accept(args.runs))
+    if args.client:
+        report("client login window", client_first_window(args.runs))
+
+
+if __name__ == "__main__":
+    main()
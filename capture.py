@@ -0,0 +1,114 @@
+import gzip
+import itertools
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+# Capture log: MAGIC, then records of kind, connection id, seconds since the
+# capture started and payload length, followed by the payload. The whole file
+# is gzip compressed. Frame payloads are the decoded JSON requests, so
+# compression negotiated on the wire does not matter to the reader.
+MAGIC = b"CDC1"
+RECORD = struct.Struct(">BIdI")
+OPEN, FRAME, CLOSE, SESSION = range(4)
+# never written to disk, replay substitutes its own credentials
+SECRETS = ("password", "token")
+
+
+class CaptureError(Exception):
+    pass
+
+
+class Capture:
+    # Records the inbound frames of every connection. Handlers only pay for a
+    # queue put, one writer thread encodes and compresses.
+    def __init__(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        self.ids = {}  # handler -> connection id
+        self.next_id = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        # owner only, the log holds private messages; a file that is already
+        # there would keep its old mode
+        if os.path.exists(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.raw = open(fd, "wb")
+        self.file = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self.file.write(MAGIC)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _put(self, kind, handler, payload=b""):
+        now = time.monotonic() - self.start
+        with self.lock:
+            conn_id = self.ids.get(handler)
+            if conn_id is None:
+                conn_id = self.ids[handler] = next(self.next_id)
+            if kind == CLOSE:
+                del self.ids[handler]
+        self.pending.put((kind, conn_id, now, payload))
+
+    def open(self, handler):
+        self._put(OPEN, handler)
+
+    def frame(self, handler, message: dict):
+        data = message.get("data")
+        if isinstance(data, dict) and any(key in data for key in SECRETS):
+            message = {
+                **message,
+                "data": {k: v for k, v in data.items() if k not in SECRETS},
+            }
+        self._put(FRAME, handler, message)
+
+    def session(self, handler, username):
+        # who a login or resume turned out to be, replay needs it for resumes
+        self._put(SESSION, handler, username.encode())
+
+    def close(self, handler):
+        self._put(CLOSE, handler)
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            kind, conn_id, now, payload = item
+            if kind == FRAME:
+                payload = json.dumps(payload, separators=(",", ":")).encode()
+            self.file.write(RECORD.pack(kind, conn_id, now, len(payload)))
+            self.file.write(payload)
+
+    def stop(self):
+        self.pending.put(None)
+        self.writer.join()
+        self.file.close()  # leaves the file object it was given open
+        self.raw.close()
+
+
+def read_capture(path):
+    # yields (kind, connection id, seconds, payload), frames decoded to dicts
+    with gzip.open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError(f"{path} is not a capture log")
+        while True:
+            try:
+                header = f.read(RECORD.size)
+                if not header:
+                    return
+                kind, conn_id, seconds, length = RECORD.unpack(header)
+                payload = f.read(length)
+            except (EOFError, struct.error):
+                # the server died mid-write, keep what is complete
+                return
+            if len(payload) < length:
+                return
+            if kind == FRAME:
+                payload = json.loads(payload)
+            elif kind == SESSION:
+                payload = payload.decode()
+            yield kind, conn_id, seconds, payload
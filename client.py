@@ -1,48 +1,259 @@
+from __future__ import annotations
+
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
+from tkinter import filedialog
 import socket
 import os
 import threading
 from dotenv import load_dotenv
 import ssl
-import json
-from utils import Message
-from typing import Optional, Any, Dict
+from utils import (
+    COMPRESSION,
+    make_message,
+    parse_message,
+    encode_frame,
+    parse_header,
+    decode_payload,
+)
+from typing import Optional, Any, Dict, TYPE_CHECKING
 import queue
+import random
+import time
+import base64
+import hashlib
+
+if TYPE_CHECKING:
+    from messages import Message
 
 load_dotenv()
 
 host = os.getenv("HOST")
 port = int(os.getenv("PORT", "65432"))
+RECONNECT_ATTEMPTS = int(os.getenv("RECONNECT_ATTEMPTS", "8"))
+RECONNECT_JITTER = float(os.getenv("RECONNECT_JITTER", "1"))
+TYPING_THROTTLE = float(os.getenv("TYPING_THROTTLE", "2"))  # seconds
+AWAY_AFTER = float(os.getenv("AWAY_AFTER", "300"))  # seconds without input
+TRANSFER_TIMEOUT = float(os.getenv("TRANSFER_TIMEOUT", "30"))  # seconds per ack
 
 
 class MessageFactory:
     @staticmethod
     def create(type: str, data: Optional[dict[str, Any]] = None) -> dict:
-        return Message(type=type, data=data).to_dict()
+        return make_message(type=type, data=data).to_dict()
+
+
+class Transfers:
+    # Attachment transfers beside the receiver thread. Uploads run in their own
+    # thread and never have more than the server's window of chunks unacked;
+    # download chunks are written to disk as they arrive. Neither side holds
+    # more than a window of the file in memory.
+    def __init__(self, server_handler: ServerHandler):
+        self.server_handler = server_handler
+        self.uploads = {}  # id -> [reply Event, free window slots, reply data]
+        self.downloads = {}  # id -> [file, path, size]
+        self.lock = threading.Lock()
+
+    def upload(self, path, to="public", room=None):
+        threading.Thread(
+            target=self._upload, args=(path, to, room), daemon=True
+        ).start()
+
+    def _upload(self, path, to, room):
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+        id = hasher.hexdigest()
+        size = os.path.getsize(path)
+        state = [threading.Event(), threading.Semaphore(0), None]
+        with self.lock:
+            self.uploads[id] = state
+        self.server_handler.send(
+            MessageFactory.create(
+                "upload",
+                {
+                    "name": os.path.basename(path),
+                    "size": size,
+                    "sha256": id,
+                    "to": to,
+                    "room": room,
+                },
+            )
+        )
+        try:
+            if not state[0].wait(TRANSFER_TIMEOUT):
+                self._fail("upload", id, "Upload timed out")
+                return
+            reply = state[2]
+            if reply is None or reply.get("complete"):
+                return
+            for _ in range(reply["window"]):
+                state[1].release()
+            with open(path, "rb") as f:
+                offset = 0
+                while offset < size:
+                    if not state[1].acquire(timeout=TRANSFER_TIMEOUT):
+                        self._fail("upload", id, "Upload timed out")
+                        return
+                    if state[2] is None:
+                        return  # the server rejected a chunk
+                    data = f.read(reply["chunk_size"])
+                    self.server_handler.send(
+                        MessageFactory.create(
+                            "upload_chunk",
+                            {
+                                "id": id,
+                                "offset": offset,
+                                "data": base64.b64encode(data).decode(),
+                            },
+                        )
+                    )
+                    offset += len(data)
+        finally:
+            with self.lock:
+                self.uploads.pop(id, None)
+
+    def download(self, id, path):
+        with self.lock:
+            self.downloads[id] = [open(path, "wb"), path, None]
+        self.server_handler.send(MessageFactory.create("download", {"id": id}))
+
+    def _fail(self, type, id, message):
+        self.server_handler.q.put(
+            make_message(type=type, status="error", message=message, data={"id": id})
+        )
+
+    def _finish_download(self, id):
+        with self.lock:
+            f, path, _ = self.downloads.pop(id)
+        f.close()
+        self.server_handler.q.put(
+            make_message(
+                type="download",
+                status="ok",
+                data={"id": id, "path": path, "complete": True},
+            )
+        )
+
+    def handle(self, msg: Message) -> bool:
+        # called on the receiver thread, True when the message is consumed
+        if msg.type == "upload_chunk":
+            state = self.uploads.get(msg.data["id"]) if msg.data else None
+            if state and msg.status != "ok":
+                state[2] = None
+            if state:
+                state[1].release()
+            return msg.status == "ok"
+        if msg.type == "upload":
+            # replies and errors alike name the upload they belong to
+            state = self.uploads.get(msg.data["id"]) if msg.data else None
+            if state:
+                state[2] = msg.data if msg.status == "ok" else None
+                state[0].set()
+            return False
+        if msg.type == "download":
+            id = msg.data["id"] if msg.data else None
+            if msg.status != "ok":
+                with self.lock:
+                    entry = self.downloads.pop(id, None)
+                if entry:
+                    entry[0].close()
+                return False
+            with self.lock:
+                waiting = [
+                    id for id, entry in self.downloads.items() if entry[2] is None
+                ]
+            if id in waiting:
+                self.downloads[id][2] = msg.data["size"]
+                if msg.data["size"] == 0:
+                    self._finish_download(id)
+            return True
+        if msg.type == "download_chunk" and msg.data:
+            id = msg.data["id"]
+            entry = self.downloads.get(id)
+            if entry is None:
+                return True
+            data = base64.b64decode(msg.data["data"])
+            entry[0].write(data)
+            received = msg.data["offset"] + len(data)
+            self.server_handler.send(
+                MessageFactory.create("download_ack", {"id": id, "offset": received})
+            )
+            if received == entry[2]:
+                self._finish_download(id)
+            return True
+        return False
 
 
 class ServerHandler:
     def __init__(self):
+        self.socket = None
+        self.token = None  # resume token from the last login
+        self.compress = False  # negotiated at login
+        self.reconnect_delay = 0.0  # hint from the server's reconnect push
+        self.pending = []  # frames sent before the connection is up
+        self.send_lock = threading.Lock()
+        self.q = queue.Queue()
+        self.transfers = Transfers(self)
+        # connect in the background so the login window shows up right away
+        self.receiver_thread = threading.Thread(target=self._run, daemon=True)
+        self.receiver_thread.start()
+
+    def _connect(self):
         context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
         context.check_hostname = False  # close for demo
         context.verify_mode = ssl.CERT_NONE  # close for demo
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         ss = context.wrap_socket(s, server_hostname=host)
         ss.connect((host, port))
-
-        self.socket = ss
-        self.q = queue.Queue()
-        self.receiver_thread = threading.Thread(target=self._recv_loop)
-        self.receiver_thread.start()
-        print("Connected to server!")
+        return ss
+
+    def _on_connected(self, ss):
+        with self.send_lock:
+            self.socket = ss
+            self.compress = False
+            if self.token:
+                self._send_now(
+                    MessageFactory.create(
+                        "resume", {"token": self.token, "compress": COMPRESSION}
+                    )
+                )
+            pending, self.pending = self.pending, []
+            for message_dict in pending:
+                self._send_now(message_dict)
+
+    def _reconnect(self) -> bool:
+        # first try honours the server's staggered hint, later ones back off
+        # exponentially, all jittered so clients do not come back in lockstep
+        delay = self.reconnect_delay + random.uniform(0, RECONNECT_JITTER)
+        self.reconnect_delay = 0.0
+        with self.send_lock:
+            self.socket = None
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(delay)
+            try:
+                ss = self._connect()
+            except OSError as e:
+                print(f"reconnect attempt {attempt + 1} failed: {e}")
+                delay = min(30.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.5)
+                continue
+            print("Reconnected to server!")
+            self._on_connected(ss)
+            return True
+        return False
 
     def send(self, message_dict):
+        with self.send_lock:
+            if self.socket is None:
+                self.pending.append(message_dict)
+                return
+            self._send_now(message_dict)
+
+    def _send_now(self, message_dict):
         try:
-            data = json.dumps(message_dict).encode("utf-8")
-            header = len(data).to_bytes(4, byteorder="big")
-            self.socket.sendall(header + data)
+            self.socket.sendall(encode_frame(message_dict, self.compress))
         except Exception as e:
             print(f"send error {e}")
             self.active = False
@@ -52,12 +263,12 @@ class ServerHandler:
         if header is None:
             print("Server closed!")
             return None
-        length = int.from_bytes(header, "big")
+        length, compressed = parse_header(header)
         payload = self._recv_exactly(length)
         if payload is None:
             print("Server closed!")
             return None
-        return json.loads(payload.decode("utf-8"))
+        return decode_payload(payload, compressed)
 
     def _recv_exactly(self, n):
         buffer = b""
@@ -73,13 +284,38 @@ class ServerHandler:
             print(f"recv error {e}")
             self.active = False
 
+    def _run(self):
+        # pydantic loads here, off the Tk thread
+        parse_message({"type": "warm_up"})
+        try:
+            self._on_connected(self._connect())
+            print("Connected to server!")
+        except OSError as e:
+            print(f"connect error {e}")
+            if not self._reconnect():
+                self.q.put({"type": "ServerClosed"})
+                return
+        self._recv_loop()
+
     def _recv_loop(self):
         while True:
             json_data = self._recv()
             if json_data is None:
+                if self._reconnect():
+                    continue
                 self.q.put({"type": "ServerClosed"})
                 break
-            msg = Message.model_validate(json_data)
+            msg = parse_message(json_data)
+            if msg.type == "reconnect":
+                self.reconnect_delay = msg.data["delay"] if msg.data else 0.0
+                continue
+            if msg.type in ("login", "resume"):
+                self.token = msg.data.get("token") if msg.data else None
+                self.compress = bool(msg.data and msg.data.get("compress") == "zlib")
+            elif msg.type == "logout":
+                self.token = None
+            elif self.transfers.handle(msg):
+                continue
             self.q.put(msg)
 
     def get_message(self):
@@ -96,6 +332,15 @@ class Dispatcher:
     def register_callback(self, message_type, callback):
         self.handlers[message_type] = callback
 
+    def unregister(self, owner):
+        # drops the callbacks of a page about to be destroyed, late pushes for
+        # it must not reach its widgets
+        self.handlers = {
+            message_type: callback
+            for message_type, callback in self.handlers.items()
+            if getattr(callback, "__self__", None) is not owner
+        }
+
     def handle(self, msg):
         message_type = msg.type
         if message_type in self.handlers:
@@ -141,7 +386,10 @@ class LoginPage(ttk.Frame):
         username = self.username_var.get()
         password = self.password_var.get()
         self.server_handler.send(
-            MessageFactory.create("login", {"username": username, "password": password})
+            MessageFactory.create(
+                "login",
+                {"username": username, "password": password, "compress": COMPRESSION},
+            )
         )
 
     def ui_register_request(self):
@@ -167,6 +415,63 @@ class LoginPage(ttk.Frame):
             messagebox.showerror("Error", msg.message)
 
 
+class RoomTab(ttk.Frame):
+    # one joined room: its messages, members and typing line
+    def __init__(self, parent, page: ChatRoomPage, room_name):
+        super().__init__(parent)
+        self.page = page
+        self.room_name = room_name
+        self.members = []
+        self.typing = set()
+        self.unread = 0
+
+        self.chat_display = tk.Text(
+            self, height=15, width=50, state="disabled", wrap="word"
+        )
+        self.chat_display.pack(pady=10, fill="both", expand=True)
+
+        self.typing_label = ttk.Label(self, text="")
+        self.typing_label.pack(anchor="w")
+
+    def append_message(self, sender, message, is_private):
+        self.chat_display.config(state="normal")
+        line = (
+            f"[Private] {sender}: {message}\n"
+            if is_private
+            else f"{sender}: {message}\n"
+        )
+        self.chat_display.insert(tk.END, line)
+        self.chat_display.config(state="disabled")
+        self.chat_display.see(tk.END)
+
+    def append_attachment(self, sender, attachment, is_private):
+        # the file name is a link, clicking it asks where to save the file
+        tag = f"attachment-{attachment['id']}"
+        prefix = f"[Private] {sender}: " if is_private else f"{sender}: "
+        self.chat_display.config(state="normal")
+        self.chat_display.insert(tk.END, prefix)
+        self.chat_display.insert(
+            tk.END, f"[file] {attachment['name']} ({attachment['size']} bytes)", tag
+        )
+        self.chat_display.insert(tk.END, "\n")
+        self.chat_display.tag_config(tag, foreground="blue", underline=True)
+        self.chat_display.tag_bind(
+            tag, "<Button-1>", lambda event: self.page.ui_download_request(attachment)
+        )
+        self.chat_display.config(state="disabled")
+        self.chat_display.see(tk.END)
+
+    def render_typing(self):
+        others = sorted(self.typing - {self.page.username})
+        if not others:
+            text = ""
+        elif len(others) <= 3:
+            text = f"{', '.join(others)} typing..."
+        else:
+            text = f"{len(others)} people typing..."
+        self.typing_label.config(text=text)
+
+
 class ChatRoomPage(ttk.Frame):
     def __init__(
         self,
@@ -180,9 +485,10 @@ class ChatRoomPage(ttk.Frame):
         super().__init__(parent, padding="20")
         self.app = app
         self.username = username
-        self.room_name = room_name
+        self.room_name = room_name  # the focused tab
         self.dispatcher = dispatcher
         self.server_handler = server_handler
+        self.tabs = {}  # room_name -> RoomTab
 
         main_frame = ttk.Frame(self)
         main_frame.pack(fill="both", expand=True)
@@ -191,26 +497,39 @@ class ChatRoomPage(ttk.Frame):
         left_frame = ttk.Frame(main_frame)
         left_frame.pack(side="left", fill="both", expand=True, padx=(0, 10))
 
-        ttk.Label(
-            left_frame, text=f"Chat Room: {room_name}", font=("Arial", 14, "bold")
-        ).pack(pady=10)
-
         ttk.Label(left_frame, text=f"You are {username}").pack(pady=5)
 
-        self.chat_display = tk.Text(
-            left_frame, height=15, width=50, state="disabled", wrap="word"
+        join_frame = ttk.Frame(left_frame)
+        join_frame.pack(fill="x", pady=5)
+        self.join_var = tk.StringVar()
+        ttk.Entry(join_frame, textvariable=self.join_var).pack(
+            side="left", fill="x", expand=True, padx=(0, 5)
         )
-        self.chat_display.pack(pady=10, fill="both", expand=True)
+        ttk.Button(join_frame, text="Close Tab", command=self.ui_leave_request).pack(
+            side="right"
+        )
+        ttk.Button(join_frame, text="Join Room", command=self.ui_join_request).pack(
+            side="right", padx=(0, 5)
+        )
+
+        self.notebook = ttk.Notebook(left_frame)
+        self.notebook.pack(fill="both", expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.ui_focus_request)
 
         input_frame = ttk.Frame(left_frame)
         input_frame.pack(fill="x", pady=5)
 
         self.msg_entry = ttk.Entry(input_frame)
         self.msg_entry.pack(side="left", fill="x", expand=True, padx=(0, 5))
+        self.msg_entry.bind("<KeyRelease>", self.ui_typing)
+        self.last_typing_sent = 0.0
 
         ttk.Button(input_frame, text="Send", command=self.ui_msg_request).pack(
             side="right"
         )
+        ttk.Button(input_frame, text="Attach", command=self.ui_upload_request).pack(
+            side="right", padx=(0, 5)
+        )
 
         ttk.Button(left_frame, text="Back to Lobby", command=self.ui_exit_request).pack(
             pady=20
@@ -230,31 +549,121 @@ class ChatRoomPage(ttk.Frame):
         # )
 
         self.dispatcher.register_callback("exit", self.server_exit_ack)
+        self.dispatcher.register_callback("join", self.server_join_ack)
+        self.dispatcher.register_callback("leave", self.server_leave_ack)
+        self.dispatcher.register_callback("focus", self.server_focus_ack)
         self.dispatcher.register_callback("list_room", self.server_list_ack)
         self.dispatcher.register_callback("msg", self.server_msg_ack)
+        self.dispatcher.register_callback("search", self.server_search_ack)
+        self.dispatcher.register_callback("presence", self.server_presence_push)
+        self.dispatcher.register_callback("upload", self.server_transfer_ack)
+        self.dispatcher.register_callback("upload_chunk", self.server_transfer_ack)
+        self.dispatcher.register_callback("download", self.server_transfer_ack)
         # self.ui_list_request()
 
-    def _append_message(self, sender, message, is_private):
-        self.chat_display.config(state="normal")
-        line = (
-            f"[Private] {sender}: {message}\n"
-            if is_private
-            else f"{sender}: {message}\n"
-        )
-        self.chat_display.insert(tk.END, line)
-        self.chat_display.config(state="disabled")
-        self.chat_display.see(tk.END)
+        tab = self._add_tab(room_name)
+        for message in self.app.offline_messages:
+            tab.append_message(f"{message['from']} (offline)", message["text"], True)
+        self.app.offline_messages.clear()
+
+    @property
+    def tab(self) -> RoomTab:
+        return self.tabs[self.room_name]
+
+    def _add_tab(self, room_name) -> RoomTab:
+        tab = self.tabs.get(room_name)
+        if tab is None:
+            tab = self.tabs[room_name] = RoomTab(self.notebook, self, room_name)
+            self.notebook.add(tab, text=room_name)
+        return tab
+
+    def _render_tab_title(self, tab: RoomTab):
+        title = f"{tab.room_name} ({tab.unread})" if tab.unread else tab.room_name
+        self.notebook.tab(tab, text=title)
+
+    def _apply_unread(self, unread: dict):
+        # the server's counters win over ours, they include what we missed
+        for room_name, count in unread.items():
+            tab = self.tabs.get(room_name)
+            if tab:
+                tab.unread = count
+                self._render_tab_title(tab)
+
+    def _render_users(self):
+        self.user_listbox.delete(0, tk.END)
+        for user in self.tab.members:
+            label = f"*{user}" if user == self.username else user
+            if user in self.app.away_users:
+                label += " (away)"
+            self.user_listbox.insert(tk.END, label)
 
     # === UI Event Handlers ===
+    def ui_typing(self, event):
+        # throttled, the server keeps the flag alive between signals
+        if not self.msg_entry.get() or event.keysym == "Return":
+            return
+        now = time.monotonic()
+        if now - self.last_typing_sent >= TYPING_THROTTLE:
+            self.last_typing_sent = now
+            self.server_handler.send(
+                MessageFactory.create("typing", {"room": self.room_name})
+            )
+
     def ui_exit_request(self):
         self.server_handler.send(MessageFactory.create("exit"))
 
+    def ui_join_request(self):
+        room_name = self.join_var.get().strip()
+        if room_name:
+            self.join_var.set("")
+            self.server_handler.send(MessageFactory.create("join", {"room": room_name}))
+
+    def ui_leave_request(self):
+        if len(self.tabs) == 1:
+            self.ui_exit_request()
+            return
+        self.server_handler.send(
+            MessageFactory.create("leave", {"room": self.room_name})
+        )
+
+    def ui_focus_request(self, event):
+        selected = self.notebook.select()
+        for room_name, tab in self.tabs.items():
+            if str(tab) == selected and room_name != self.room_name:
+                self.room_name = room_name
+                tab.unread = 0
+                self._render_tab_title(tab)
+                self._render_users()
+                self.server_handler.send(
+                    MessageFactory.create("focus", {"room": room_name})
+                )
+
+    def ui_upload_request(self):
+        path = filedialog.askopenfilename(title="Attach file")
+        if path:
+            self.server_handler.transfers.upload(path, room=self.room_name)
+
+    def ui_download_request(self, attachment):
+        path = filedialog.asksaveasfilename(initialfile=attachment["name"])
+        if path:
+            self.server_handler.transfers.download(attachment["id"], path)
+
     def ui_msg_request(self):
         msg = self.msg_entry.get().strip()
         if not msg:
             return
 
         self.msg_entry.delete(0, tk.END)
+        self.last_typing_sent = 0.0
+        if msg.startswith(r"\search"):
+            query = msg[len(r"\search") :].strip()
+            if query:
+                self.server_handler.send(
+                    MessageFactory.create(
+                        "search", {"query": query, "page": 0, "room": self.room_name}
+                    )
+                )
+            return
         if msg.startswith(r"\private"):
             parts = msg.split(maxsplit=2)
             if len(parts) < 3:
@@ -262,17 +671,19 @@ class ChatRoomPage(ttk.Frame):
                 return
 
             _, receiver, message = parts  # 丟掉第一個 "\private"
-            self.server_handler.send(
-                MessageFactory.create(
-                    "msg", {"from": self.username, "to": receiver, "text": message}
-                )
-            )
         else:
-            self.server_handler.send(
-                MessageFactory.create(
-                    "msg", {"from": self.username, "to": "public", "text": msg}
-                )
+            receiver, message = "public", msg
+        self.server_handler.send(
+            MessageFactory.create(
+                "msg",
+                {
+                    "from": self.username,
+                    "to": receiver,
+                    "text": message,
+                    "room": self.room_name,
+                },
             )
+        )
 
     # def ui_list_request(self):
     #     self.server_handler.send(MessageFactory.create("list"))
@@ -286,26 +697,87 @@ class ChatRoomPage(ttk.Frame):
         else:
             print("Server-side error", msg.message)
 
+    def server_join_ack(self, msg: Message):
+        if msg.status != "ok" or msg.data is None:
+            messagebox.showerror("Join", msg.message)
+            return
+        self._add_tab(msg.data["room"])
+        self._apply_unread(msg.data["unread"])
+
+    def server_leave_ack(self, msg: Message):
+        if msg.status != "ok" or msg.data is None:
+            messagebox.showerror("Leave", msg.message)
+            return
+        tab = self.tabs.pop(msg.data["room"], None)
+        self.room_name = msg.data["chatroom"]
+        if tab:
+            self.notebook.forget(tab)
+            tab.destroy()
+        self.notebook.select(self.tab)
+        self._apply_unread(msg.data["unread"])
+        self._render_users()
+
+    def server_focus_ack(self, msg: Message):
+        if msg.status == "ok" and msg.data is not None:
+            self._apply_unread(msg.data["unread"])
+
     def server_list_ack(self, msg: Message):
         if msg.data is None:
             return
-        self.user_listbox.delete(0, tk.END)
-        for user in msg.data.get(self.room_name, []):
-            self.user_listbox.insert(
-                tk.END, f"*{user}" if user == self.username else user
-            )
+        for room_name, members in msg.data.items():
+            tab = self.tabs.get(room_name)
+            if tab:
+                tab.members = members
+        self._render_users()
+
+    def server_presence_push(self, msg: Message):
+        tab = self.tabs.get(msg.data["room"]) if msg.data else None
+        if tab is None:
+            return
+        users = self.app.apply_presence(msg.data["users"])
+        for user, changes in users.items():
+            if changes.get("typing"):
+                tab.typing.add(user)
+            elif "typing" in changes:
+                tab.typing.discard(user)
+        self._render_users()
+        tab.render_typing()
+
+    def server_search_ack(self, msg: Message):
+        if msg.status != "ok" or msg.data is None:
+            return
+        tab = self.tabs.get(msg.data["room"], self.tab)
+        hits = msg.data["hits"]
+        tab.append_message(
+            "Search", f"{msg.data['total']} results for '{msg.data['query']}'", False
+        )
+        for hit in hits:
+            tab.append_message(f"  #{hit['id']} {hit['from']}", hit["text"], False)
 
     def server_msg_ack(self, msg: Message):
         if msg.status == "ok" and msg.data is not None:
+            tab = self.tabs.get(msg.data.get("room"), self.tab)
             sender = msg.data["from"]
             receiver = msg.data["to"]
             sender = "You" if sender == self.username else sender
             is_private = receiver == self.username
             text = msg.data["text"]
-            self._append_message(sender, text, is_private)
+            if "attachment" in msg.data:
+                tab.append_attachment(sender, msg.data["attachment"], is_private)
+            else:
+                tab.append_message(sender, text, is_private)
+            if tab is not self.tab and sender != "You":
+                tab.unread += 1
+                self._render_tab_title(tab)
         else:
             messagebox.showerror("Error", msg.message)
 
+    def server_transfer_ack(self, msg: Message):
+        if msg.status != "ok":
+            messagebox.showerror("Transfer", msg.message)
+        elif msg.type == "download" and msg.data and msg.data.get("complete"):
+            self.tab.append_message("Download", f"saved to {msg.data['path']}", False)
+
 
 class LobbyPage(ttk.Frame):
     def __init__(
@@ -377,6 +849,8 @@ class LobbyPage(ttk.Frame):
         self.dispatcher.register_callback("logout", self.server_logout_ack)
         self.dispatcher.register_callback("enter", self.server_enter_room_ack)
         self.dispatcher.register_callback("create", self.server_create_room_ack)
+        self.dispatcher.register_callback("presence", self.server_presence_push)
+        self.rooms = {}
         # self.ui_list_request()
 
     # === UI Event Handlers ===
@@ -424,12 +898,25 @@ class LobbyPage(ttk.Frame):
     def server_list_ack(self, msg: Message):
         if msg.data is None:
             return
+        self.rooms = msg.data
+        self._render_rooms()
 
+    def server_presence_push(self, msg: Message):
+        if msg.data is None or msg.data["room"] != "lobby":
+            return
+        self.app.apply_presence(msg.data["users"])
+        self._render_rooms()
+
+    def _render_rooms(self):
         for item in self.user_tree.get_children():
             self.user_tree.delete(item)
 
-        for room, users in msg.data.items():
-            members = ", ".join(users) if users else "No users online"
+        for room, users in self.rooms.items():
+            names = [
+                f"{user} (away)" if user in self.app.away_users else user
+                for user in users
+            ]
+            members = ", ".join(names) if users else "No users online"
             self.user_tree.insert(
                 "",
                 "end",
@@ -448,6 +935,15 @@ class App(tk.Tk):
         self.current_page = None
         self.current_username = None
         self.current_chatroom = None
+        self.offline_messages = []  # shown by the next chat room page
+        self.away_users = set()
+        self.away = False
+        self.last_input = time.monotonic()
+        self.bind_all("<Key>", self.on_user_input, add="+")
+        self.bind_all("<Motion>", self.on_user_input, add="+")
+        self.after(10_000, self.check_idle)
+        self.dispatcher.register_callback("resume", self.server_resume_ack)
+        self.dispatcher.register_callback("inbox", self.server_inbox_push)
         self.poll_messages()
         self.show_login_page()
 
@@ -455,28 +951,88 @@ class App(tk.Tk):
         messagebox.showerror("Disconnected", "Server connection lost. Closing app...")
         self.after(100, self.destroy)
 
+    def server_resume_ack(self, msg: Message):
+        if msg.status == "ok" and msg.data is not None:
+            self.away = False  # a new connection starts out online
+            username = msg.data["username"]
+            chatroom = msg.data["chatroom"]
+            if chatroom == "lobby":
+                self.show_lobby_page(username, chatroom)
+            else:
+                self.current_username = username
+                self.current_chatroom = "lobby"
+                self.show_chatroom_page(username, chatroom)
+        else:
+            messagebox.showwarning("Reconnect", msg.message)
+            self.show_login_page()
+
+    def apply_presence(self, users: dict) -> dict:
+        for user, changes in users.items():
+            if changes.get("status") == "away":
+                self.away_users.add(user)
+            elif "status" in changes:
+                self.away_users.discard(user)
+        return users
+
+    def on_user_input(self, event):
+        self.last_input = time.monotonic()
+        if self.away and self.current_username:
+            self.away = False
+            self.server_handler.send(
+                MessageFactory.create("presence", {"status": "online"})
+            )
+
+    def check_idle(self):
+        idle = time.monotonic() - self.last_input
+        if not self.away and self.current_username and idle >= AWAY_AFTER:
+            self.away = True
+            self.server_handler.send(
+                MessageFactory.create("presence", {"status": "away"})
+            )
+        self.after(10_000, self.check_idle)
+
+    def server_inbox_push(self, msg: Message):
+        if msg.data is None:
+            return
+        self.offline_messages.extend(msg.data["messages"])
+        self.server_handler.send(
+            MessageFactory.create("inbox_ack", {"last_id": msg.data["last_id"]})
+        )
+        if not msg.data["more"]:
+            count = len(self.offline_messages)
+            messagebox.showinfo(
+                "Inbox", f"{count} messages arrived while you were away"
+            )
+
     def poll_messages(self):
         # handle the events (response/push) from server
-        msg = self.server_handler.get_message()
-        while msg:
-            print(f"Get new message from server: {msg}")
-            if isinstance(msg, dict) and msg.get("type") == "ServerClosed":
-                self.on_server_disconnect()
-                break
-
-            self.dispatcher.handle(msg)
+        closed = False
+        try:
             msg = self.server_handler.get_message()
-        else:
-            self.after(100, self.poll_messages)
+            while msg:
+                print(f"Get new message from server: {msg}")
+                if isinstance(msg, dict) and msg.get("type") == "ServerClosed":
+                    self.on_server_disconnect()
+                    closed = True
+                    break
+
+                self.dispatcher.handle(msg)
+                msg = self.server_handler.get_message()
+        finally:
+            # a failing callback must not stop the polling for good
+            if not closed:
+                self.after(100, self.poll_messages)
 
     def show_login_page(self):
         if self.current_page:
+            self.dispatcher.unregister(self.current_page)
             self.current_page.destroy()
         self.current_page = LoginPage(self, self, self.dispatcher, self.server_handler)
         self.current_page.pack(fill="both", expand=True)
 
     def show_lobby_page(self, username, chatroom):
         if self.current_page:
+            self.dispatcher.unregister(self.current_page)
             self.current_page.destroy()
         self.current_username = username
         self.current_chatroom = chatroom
@@ -487,6 +1043,7 @@ class App(tk.Tk):
 
     def show_chatroom_page(self, username, chatroom):
         if self.current_page:
+            self.dispatcher.unregister(self.current_page)
             self.current_page.destroy()
         self.current_page = ChatRoomPage(
             self, self, username, chatroom, self.dispatcher, self.server_handler
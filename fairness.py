@@ -0,0 +1,164 @@
+import os
+import time
+
+# frames a connection may handle back to back before yielding to the others
+READ_BUDGET = int(os.getenv("READ_BUDGET", "16"))
+# handler CPU seconds a connection may use per second, and how much unused
+# quota it may save up for a burst (logins and searches cost more than a msg)
+CPU_QUOTA = float(os.getenv("CPU_QUOTA", "0.1"))
+CPU_BURST = float(os.getenv("CPU_BURST", "0.5"))
+# seconds of handler CPU the fairness index looks back over, connections idle
+# for that long are left out of it
+FAIRNESS_WINDOW = float(os.getenv("FAIRNESS_WINDOW", "10"))
+# longest single throttle sleep, so a closed connection notices soon
+MAX_THROTTLE = 1.0
+# releases the GIL and the CPU, sleep(0) does the former only
+yield_cpu = getattr(os, "sched_yield", lambda: time.sleep(0))
+
+
+class Share:
+    # What one connection has taken from the server. Only its handler thread
+    # writes it, readers may see a frame's worth of staleness.
+    __slots__ = (
+        "frames",
+        "turn",
+        "cpu",
+        "credit",
+        "refilled",
+        "throttled",
+        "window_start",
+        "window_cpu",
+        "last_window_cpu",
+        "pipelined",
+        "window_frames",
+        "last_window_frames",
+        "window_waiting",
+        "last_window_waiting",
+    )
+
+    def __init__(self):
+        self.frames = 0
+        self.turn = 0  # frames since the last yield
+        self.cpu = 0.0  # handler CPU seconds, blocking reads are not counted
+        self.credit = CPU_BURST
+        self.refilled = time.monotonic()
+        self.throttled = 0.0  # seconds spent waiting for quota
+        # the last frame read had the next one queued behind it
+        self.pipelined = False
+        # CPU and frames in the current FAIRNESS_WINDOW and in the one
+        # before it; waiting counts frames that show unmet demand: throttled
+        # ones under a quota, pipelined ones without
+        self.window_start = self.refilled
+        self.window_cpu = 0.0
+        self.last_window_cpu = 0.0
+        self.window_frames = 0
+        self.last_window_frames = 0
+        self.window_waiting = 0
+        self.last_window_waiting = 0
+
+    def charge(self, cpu):
+        # called after every frame; sleeping here leaves the rest of the
+        # connection's frames in the socket, so a flood backs up at the sender
+        self.frames += 1
+        self.cpu += cpu
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= FAIRNESS_WINDOW:
+            # the window just closed counts, one closed before that does not
+            if elapsed < 2 * FAIRNESS_WINDOW:
+                self.last_window_cpu = self.window_cpu
+                self.last_window_frames = self.window_frames
+                self.last_window_waiting = self.window_waiting
+            else:
+                self.last_window_cpu = 0.0
+                self.last_window_frames = self.last_window_waiting = 0
+            self.window_cpu = 0.0
+            self.window_frames = self.window_waiting = 0
+            self.window_start = now
+        self.window_cpu += cpu
+        self.window_frames += 1
+        if self.pipelined and CPU_QUOTA <= 0:
+            self.window_waiting += 1
+        self.pipelined = False
+        if CPU_QUOTA > 0:
+            self.credit = min(
+                CPU_BURST, self.credit + (now - self.refilled) * CPU_QUOTA
+            )
+            self.refilled = now
+            self.credit -= cpu
+            if self.credit < 0:
+                pause = min(-self.credit / CPU_QUOTA, MAX_THROTTLE)
+                time.sleep(pause)
+                self.throttled += pause
+                self.window_waiting += 1
+                self.turn = 0
+                return
+        self.turn += 1
+        if READ_BUDGET and self.turn >= READ_BUDGET:
+            # end of the turn, let every other runnable connection go first
+            self.turn = 0
+            yield_cpu()
+
+    def recent(self, now) -> tuple[float, float, bool]:
+        # (CPU, seconds covered, backlogged) over the last one to two windows,
+        # no CPU once the connection idled through a whole window. Backlogged:
+        # the connection wanted more than it got. Under a quota that is being
+        # throttled; without one, most frames having the next one waiting,
+        # rather than a request pipelined now and then.
+        elapsed = now - self.window_start
+        if elapsed >= 2 * FAIRNESS_WINDOW:
+            return 0.0, 0.0, False
+        if elapsed >= FAIRNESS_WINDOW:
+            cpu, frames, waiting = (
+                self.window_cpu,
+                self.window_frames,
+                self.window_waiting,
+            )
+        else:
+            cpu = self.last_window_cpu + self.window_cpu
+            frames = self.last_window_frames + self.window_frames
+            waiting = self.last_window_waiting + self.window_waiting
+            elapsed += FAIRNESS_WINDOW
+        backlogged = waiting > 0 if CPU_QUOTA > 0 else 2 * waiting > frames
+        return cpu, elapsed, backlogged
+
+    def to_dict(self, total_cpu) -> dict:
+        return {
+            "frames": self.frames,
+            "cpu_ms": round(self.cpu * 1000, 3),
+            "throttled_ms": round(self.throttled * 1000, 3),
+            "cpu_share": round(self.cpu / total_cpu, 4) if total_cpu else 0.0,
+        }
+
+
+def fairness_report(shares: list[Share], own: Share) -> dict:
+    # Jain's index over busy connections (frames in the window) of CPU used
+    # against what each was due, min(demand, quota). A connection that was
+    # not backlogged got all it asked for, x = 1. A backlogged one wanted
+    # more, so it is measured against its quota, or against an equal share of
+    # the CPU when quotas are off. 1.0 when nobody got more than its due at
+    # the others' expense, lower as a flooder takes over.
+    now = time.monotonic()
+    recent = [r for r in (share.recent(now) for share in shares) if r[0] > 0]
+    total = sum(cpu for cpu, _, _ in recent)
+    ratios = []
+    for cpu, seconds, backlogged in recent:
+        if not backlogged:
+            ratios.append(1.0)
+        elif CPU_QUOTA > 0:
+            ratios.append(cpu / (CPU_QUOTA * seconds + CPU_BURST))
+        else:
+            ratios.append(cpu * len(recent) / total)
+    squares = sum(x * x for x in ratios)
+    return {
+        "connections": len(shares),
+        "busy": len(recent),
+        "jain": (
+            round(sum(ratios) ** 2 / (len(ratios) * squares), 4) if squares else 1.0
+        ),
+        "max_cpu_share": (
+            round(max(cpu for cpu, _, _ in recent) / total, 4) if total else 0.0
+        ),
+        "throttled": sum(1 for share in shares if share.throttled),
+        "connection": own.to_dict(sum(share.cpu for share in shares)),
+    }
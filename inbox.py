@@ -0,0 +1,118 @@
+import threading
+import time
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    delete,
+    insert,
+    select,
+)
+
+
+# Private messages for offline users. Writes are buffered and flushed in
+# batches, each user keeps at most `limit` messages (oldest dropped first).
+class Inbox:
+    def __init__(
+        self,
+        engine,
+        metadata_obj: MetaData,
+        limit=1000,
+        batch_size=200,
+        flush_interval=0.5,
+    ):
+        self.engine = engine
+        self.limit = limit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.messages = Table(
+            "inbox",
+            metadata_obj,
+            Column("id", Integer, primary_key=True),
+            Column("receiver", String, nullable=False, index=True),
+            Column("sender", String, nullable=False),
+            Column("text", String, nullable=False),
+            Column("created", Float, nullable=False),
+        )
+        self.pending = []  # rows waiting for the next flush
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def put(self, receiver, sender, text):
+        with self.lock:
+            self.pending.append(
+                {
+                    "receiver": receiver,
+                    "sender": sender,
+                    "text": text,
+                    "created": time.time(),
+                }
+            )
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def flush(self):
+        # serialize flushes so a reader that flushed first sees every write
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, []
+            if not rows:
+                return
+            receivers = {row["receiver"] for row in rows}
+            with self.engine.begin() as conn:
+                conn.execute(insert(self.messages), rows)
+                for receiver in receivers:
+                    cutoff = (
+                        select(self.messages.c.id)
+                        .where(self.messages.c.receiver == receiver)
+                        .order_by(self.messages.c.id.desc())
+                        .offset(self.limit)
+                        .limit(1)
+                        .scalar_subquery()
+                    )
+                    conn.execute(
+                        delete(self.messages).where(
+                            self.messages.c.receiver == receiver,
+                            self.messages.c.id <= cutoff,
+                        )
+                    )
+
+    def _flush_loop(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Inbox flush error: {e}")
+
+    def fetch(self, receiver, after_id=0, limit=500) -> list[dict]:
+        stmt = (
+            select(self.messages)
+            .where(self.messages.c.receiver == receiver, self.messages.c.id > after_id)
+            .order_by(self.messages.c.id)
+            .limit(limit)
+        )
+        with self.engine.connect() as conn:
+            return [
+                {
+                    "id": row.id,
+                    "from": row.sender,
+                    "text": row.text,
+                    "time": row.created,
+                }
+                for row in conn.execute(stmt)
+            ]
+
+    def ack(self, receiver, last_id):
+        stmt = delete(self.messages).where(
+            self.messages.c.receiver == receiver, self.messages.c.id <= last_id
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
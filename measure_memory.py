@@ -0,0 +1,135 @@
+import argparse
+import gc
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Measures what one connection costs the server process, without TLS:
+#   python measure_memory.py --connections 2000 --active 200
+#   python measure_memory.py --check   # exit 1 when over the budget
+# "python" is heap traced by tracemalloc (ClientHandler, membership, buffers);
+# "rss" also includes thread stacks. OpenSSL state per TLS connection is not
+# part of either number.
+
+# Measured with the defaults on CPython 3.11, Linux x86_64: about 5.4 KiB
+# python per idle connection (the handler and its outbox) and 11.4 to 11.7 KiB
+# per active one (its writer thread, buffers and room traffic). The budgets
+# leave roughly 30% on top of that, so run to run noise does not fail the
+# check but a new per-connection structure does.
+IDLE_BUDGET = int(os.getenv("IDLE_BUDGET", "7168"))  # python bytes
+ACTIVE_BUDGET = int(os.getenv("ACTIVE_BUDGET", "15360"))  # python bytes
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def settle():
+    time.sleep(0.5)
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0], rss_bytes()
+
+
+def open_connection(server, chat_data, username, room, peers, run):
+    ours, theirs = socket.socketpair()
+    handler = server.ClientHandler(ours, ("measure", 0), chat_data)
+    handler.username = sys.intern(username)
+    handler.chatroom = room
+    handler.state = "lobby" if room == "lobby" else "chat"
+    chat_data.add_online_user(handler.username, handler)
+    chat_data.get_room(room).add(handler.username)
+    # idle connections just wait for the next frame, active ones run the
+    # full state machine
+    target = handler.run if run else handler.recv
+    threading.Thread(target=target, daemon=True).start()
+    peers.append(theirs)
+    return handler
+
+
+def drain(peers):
+    for peer in peers:
+        peer.setblocking(False)
+        try:
+            while peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        peer.setblocking(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-connection memory footprint")
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--active", type=int, default=200)
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument(
+        "--check", action="store_true", help="exit 1 if a budget is exceeded"
+    )
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite+pysqlite:///{tmp}/measure.db"
+    import server
+    from utils import encode_frame
+
+    threading.stack_size(server.THREAD_STACK_SIZE)
+    chat_data = server.ChatData()
+    # lazy imports (database, pydantic) are process-wide, not per connection
+    server.warm_up(chat_data)
+    peers = []
+
+    tracemalloc.start()
+    base_py, base_rss = settle()
+    for i in range(args.connections):
+        open_connection(server, chat_data, f"idle{i}", "lobby", peers, run=False)
+    idle_py, idle_rss = settle()
+
+    active_peers = []
+    for i in range(args.active):
+        room = f"room{i // args.room_size}"
+        if chat_data.get_room(room) is None:
+            chat_data.create_room(room)
+        open_connection(server, chat_data, f"active{i}", room, active_peers, run=True)
+    for i, peer in enumerate(active_peers):
+        peer.sendall(encode_frame({"type": "list"}))
+        peer.sendall(
+            encode_frame(
+                {
+                    "type": "msg",
+                    "data": {"from": f"active{i}", "to": "public", "text": "hi"},
+                }
+            )
+        )
+    time.sleep(1)
+    drain(active_peers)
+    active_py, active_rss = settle()
+    tracemalloc.stop()
+
+    per_idle_py = (idle_py - base_py) / args.connections
+    per_idle_rss = (idle_rss - base_rss) / args.connections
+    per_active_py = (active_py - idle_py) / max(args.active, 1)
+    per_active_rss = (active_rss - idle_rss) / max(args.active, 1)
+    print(f"idle:   {per_idle_py:8.0f} B python  {per_idle_rss:8.0f} B rss")
+    print(f"active: {per_active_py:8.0f} B python  {per_active_rss:8.0f} B rss")
+    print(f"budget: {IDLE_BUDGET} B idle, {ACTIVE_BUDGET} B active (python)")
+
+    failed = per_idle_py > IDLE_BUDGET or per_active_py > ACTIVE_BUDGET
+    if args.check and failed:
+        print("FAIL: per-connection footprint over budget")
+    sys.stdout.flush()
+    # skip interpreter teardown, thousands of handler threads would log their exit
+    os._exit(1 if args.check and failed else 0)
+
+
+if __name__ == "__main__":
+    main()
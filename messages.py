@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+from typing import Optional, Dict, Any
+
+
+class Message(BaseModel):
+    type: str
+    status: Optional[str] = None  # "ok" / "error" (response only)
+    message: Optional[str] = None  # human-readable
+    data: Optional[Dict[str, Any]] = None
+
+    def to_dict(self):
+        return self.model_dump(exclude_unset=True)
@@ -0,0 +1,278 @@
+import math
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+from array import array
+from collections import deque
+
+# Priority classes of outbound frames, lower goes first
+CONTROL = 0  # replies to the connection's own requests, errors, reconnect
+DIRECT = 1  # private messages
+ROOM = 2  # room broadcasts
+BULK = 3  # member lists, presence, inbox pages
+CLASSES = ("control", "direct", "room", "bulk")
+
+# a class whose oldest frame waited this long is served before higher ones
+MAX_WAIT = float(os.getenv("OUTBOX_MAX_WAIT", "0.2"))
+# bytes written per slice, higher classes can cut in between slices
+WRITE_BUDGET = int(os.getenv("OUTBOX_WRITE_BUDGET", str(16 * 1024)))
+# seconds a writer thread waits for frames before it exits
+WRITER_IDLE = float(os.getenv("OUTBOX_WRITER_IDLE", "5"))
+# bytes queued for one connection before it counts as a slow consumer
+LIMIT = int(os.getenv("OUTBOX_LIMIT", str(4 * 1024 * 1024)))
+LATENCY_SAMPLES = 1024
+# a non-blocking socket has nothing to read or no room to write yet
+WOULD_BLOCK = (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError)
+
+
+def wait_io(conn, writable=False, timeout=None) -> bool:
+    # poll rather than select, descriptors go past 1024 with enough clients
+    poller = select.poll()
+    try:
+        poller.register(conn, select.POLLOUT if writable else select.POLLIN)
+    except (ValueError, OSError):
+        return True  # closed, the next call on it reports that
+    return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+
+class OutboxFull(Exception):
+    pass
+
+
+def percentile_ms(samples, p) -> float:
+    # samples sorted, nearest rank: the smallest sample with at least p of
+    # all samples at or below it
+    if not samples:
+        return 0.0
+    rank = max(math.ceil(p * len(samples)) - 1, 0)
+    return round(samples[rank] * 1000, 3)
+
+
+class OutboxStats:
+    # queueing latency per class, from enqueue until the bytes left sendall
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = [0] * len(CLASSES)
+        self.total = [0.0] * len(CLASSES)
+        self.max = [0.0] * len(CLASSES)
+        # rings of the latest latencies, unboxed so they cost 8 bytes each
+        self.samples = [array("d") for _ in CLASSES]
+
+    def record(self, latencies):
+        # latencies: [(priority, seconds)], one lock round per write
+        with self.lock:
+            for priority, latency in latencies:
+                samples = self.samples[priority]
+                if len(samples) < LATENCY_SAMPLES:
+                    samples.append(latency)
+                else:
+                    samples[self.frames[priority] % LATENCY_SAMPLES] = latency
+                self.frames[priority] += 1
+                self.total[priority] += latency
+                if latency > self.max[priority]:
+                    self.max[priority] = latency
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            result = {}
+            for priority, name in enumerate(CLASSES):
+                samples = sorted(self.samples[priority])
+                count = self.frames[priority]
+                result[name] = {
+                    "frames": count,
+                    "avg_ms": (
+                        round(self.total[priority] / count * 1000, 3) if count else 0.0
+                    ),
+                    "p50_ms": percentile_ms(samples, 0.5),
+                    "p99_ms": percentile_ms(samples, 0.99),
+                    "max_ms": round(self.max[priority] * 1000, 3),
+                }
+            return result
+
+
+outbox_stats = OutboxStats()
+
+
+class Outbox:
+    # Per-connection send queue with one FIFO per priority class, written by
+    # the connection's own writer thread. Everyone else only queues, so a room
+    # worker fanning out to a member who stopped reading never blocks on that
+    # member's socket. The writer sends in slices, so a reply queued during a
+    # broadcast burst goes out with the next slice instead of after the whole
+    # burst. It is started on demand and exits after WRITER_IDLE seconds
+    # without frames, so idle connections do not keep a thread for it.
+    # At most LIMIT bytes wait in the queues; past that put_many raises
+    # OutboxFull and the caller drops the connection rather than buffer
+    # without bound for a client that does not read.
+    # A barrier put (a reply that moves the client to another page) is not
+    # overtaken: everything queued before it goes out first, in queue order.
+    # An OpenSSL connection must not be used by two threads at once, so the
+    # socket is non-blocking and the handler's reads (see read) and the
+    # writer's sends each hold self.tls for one call only.
+    __slots__ = (
+        "conn",
+        "tls",
+        "queues",
+        "queued",
+        "ready",
+        "writer",
+        "busy",
+        "closed",
+    )
+
+    def __init__(self, conn):
+        self.conn = conn
+        conn.setblocking(False)
+        self.tls = threading.Lock()
+        self.queues = {}  # priority -> deque of (enqueued, data), only non-empty
+        self.queued = 0  # bytes in self.queues
+        self.ready = threading.Condition(threading.Lock())
+        self.writer = None  # the writer thread while it runs
+        self.busy = False  # a slice taken off the queues is being sent
+        self.closed = False
+
+    def put(self, priority, data: bytes):
+        self.put_many([(priority, data)])
+
+    def put_many(self, items, barrier=False):
+        now = time.monotonic()
+        with self.ready:
+            if self.closed:
+                return
+            size = sum(len(data) for _, data in items)
+            # an empty outbox takes anything, a single frame may be large
+            if self.queued and self.queued + size > LIMIT:
+                raise OutboxFull(f"{self.queued} bytes still queued")
+            self.queued += size
+            if barrier and self.queues:
+                # one FIFO in enqueue order, the barrier's class is served first
+                queued = sorted(
+                    (
+                        entry
+                        for _, fifo in sorted(self.queues.items())
+                        for entry in fifo
+                    ),
+                    key=lambda entry: entry[0],
+                )
+                self.queues = {items[0][0]: deque(queued)}
+            for priority, data in items:
+                fifo = self.queues.get(priority)
+                if fifo is None:
+                    fifo = self.queues[priority] = deque()
+                fifo.append((now, data))
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+            else:
+                self.ready.notify_all()
+
+    def _next_class(self, now):
+        classes = sorted(self.queues)
+        # anti-starvation: the longest waiting class past MAX_WAIT goes first
+        starved = [p for p in classes[1:] if now - self.queues[p][0][0] > MAX_WAIT]
+        if starved:
+            return min(starved, key=lambda p: self.queues[p][0][0])
+        return classes[0]
+
+    def _take(self):
+        now = time.monotonic()
+        priority = self._next_class(now)
+        fifo = self.queues[priority]
+        taken = []
+        size = 0
+        while fifo and (not taken or size + len(fifo[0][1]) <= WRITE_BUDGET):
+            enqueued, data = fifo.popleft()
+            taken.append((enqueued, data))
+            size += len(data)
+        self.queued -= size
+        if not fifo:
+            del self.queues[priority]
+        return priority, taken
+
+    def _write_loop(self):
+        while True:
+            with self.ready:
+                self.busy = False
+                if not self.queues and not self.closed:
+                    self.ready.notify_all()  # wakes flush()
+                    self.ready.wait(WRITER_IDLE)
+                if self.closed or not self.queues:
+                    # a fresh dict, the emptied one keeps its grown table;
+                    # the next put starts a new writer
+                    self.queues = {}
+                    self.queued = 0
+                    self.writer = None
+                    self.ready.notify_all()
+                    return
+                priority, taken = self._take()
+                self.busy = True
+            try:
+                self._send(b"".join(data for _, data in taken))
+            except Exception as e:
+                print(f"send error {e}")
+                self.close()
+                self.shutdown()  # wakes the reading side, which cleans up
+                continue
+            done = time.monotonic()
+            outbox_stats.record([(priority, done - enqueued) for enqueued, _ in taken])
+
+    def _send(self, data: bytes):
+        view = memoryview(data)
+        while view and not self.closed:
+            with self.tls:
+                try:
+                    # all or nothing, OpenSSL wants the same buffer on a retry
+                    sent = self.conn.send(view)
+                except WOULD_BLOCK:
+                    sent = 0
+            if sent:
+                view = view[sent:]
+            else:
+                # a consumer that stopped reading parks us here, not the room
+                wait_io(self.conn, writable=True, timeout=1.0)
+
+    def read(self, n) -> bytes:
+        # for the handler thread, returns b"" once the peer is gone
+        while True:
+            with self.tls:
+                try:
+                    return self.conn.recv(n)
+                except ssl.SSLWantWriteError:
+                    writable = True
+                except (ssl.SSLWantReadError, BlockingIOError):
+                    writable = False
+            wait_io(self.conn, writable)
+
+    def readable(self) -> bool:
+        # the next frame is already here: decrypted in TLS or in the socket
+        if isinstance(self.conn, ssl.SSLSocket):
+            with self.tls:
+                if self.conn.pending():
+                    return True
+        return wait_io(self.conn, timeout=0)
+
+    def flush(self, timeout):
+        # wait until everything queued so far is written, e.g. before a shutdown
+        with self.ready:
+            self.ready.wait_for(
+                lambda: self.closed or not (self.queues or self.busy), timeout
+            )
+
+    def shutdown(self):
+        # Shut the TCP socket down underneath TLS. SSLSocket.shutdown drops the
+        # TLS state first, so a read racing with it would return raw records.
+        try:
+            socket.socket.shutdown(self.conn, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        # drops whatever is still queued
+        with self.ready:
+            self.closed = True
+            self.queues.clear()
+            self.queued = 0
+            self.ready.notify_all()
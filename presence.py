@@ -0,0 +1,83 @@
+import threading
+import time
+
+
+class PresenceHub:
+    # Collects away/online and typing changes per room and publishes at most
+    # one update per room per tick. Only transitions are recorded: a typing
+    # signal from someone already typing just pushes the expiry back.
+    def __init__(self, publish, tick=0.5, typing_ttl=4.0):
+        self.publish = publish  # publish(room_name, {username: changes})
+        self.tick = tick
+        self.typing_ttl = typing_ttl
+        self.away = set()
+        self.typing = {}  # (room_name, username) -> expiry (monotonic)
+        self.changes = {}  # room_name -> {username: {"status", "typing"}}
+        self.lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _mark(self, room, username, **fields):
+        self.changes.setdefault(room, {}).setdefault(username, {}).update(fields)
+
+    def set_status(self, username, rooms, status):
+        away = status == "away"
+        with self.lock:
+            if (username in self.away) == away:
+                return
+            if away:
+                self.away.add(username)
+            else:
+                self.away.discard(username)
+            # the lobby page lists everyone, so it hears about every room
+            for room in {*rooms, "lobby"}:
+                self._mark(room, username, status=status)
+
+    def start_typing(self, username, room):
+        with self.lock:
+            started = (room, username) not in self.typing
+            self.typing[(room, username)] = time.monotonic() + self.typing_ttl
+            if started:
+                self._mark(room, username, typing=True)
+
+    def stop_typing(self, username, room):
+        with self.lock:
+            if self.typing.pop((room, username), None) is not None:
+                self._mark(room, username, typing=False)
+
+    def forget(self, username, rooms):
+        for room in rooms:
+            self.stop_typing(username, room)
+        with self.lock:
+            self.away.discard(username)
+
+    def snapshot(self, room, members) -> dict:
+        # current state for someone who just joined `room`
+        with self.lock:
+            users = {
+                username: {"status": "away"}
+                for username in (self.away if room == "lobby" else members)
+                if username in self.away
+            }
+            for typing_room, username in self.typing:
+                if typing_room == room:
+                    users.setdefault(username, {})["typing"] = True
+        return users
+
+    def flush(self):
+        now = time.monotonic()
+        with self.lock:
+            for (room, username), expiry in list(self.typing.items()):
+                if expiry < now:
+                    del self.typing[(room, username)]
+                    self._mark(room, username, typing=False)
+            changes, self.changes = self.changes, {}
+        for room, users in changes.items():
+            self.publish(room, users)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Presence flush error: {e}")
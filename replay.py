@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import socket
+import ssl
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+
+from capture import CLOSE, FRAME, OPEN, SESSION, read_capture
+from outbox import percentile_ms
+from utils import decode_payload, encode_frame, parse_header
+
+# Re-drives a capture made with `python server.py --capture traffic.cdc`:
+#   python replay.py run traffic.cdc --port 65432 --speed 10 --out new.json
+#   python replay.py diff base.json new.json
+# Every captured connection gets its own TLS connection and sends its frames at
+# the recorded offsets divided by --speed. Passwords are not captured, so each
+# login is preceded by a register with REPLAY_PASSWORD; replay against a fresh
+# database (or one that only saw replays).
+
+REPLAY_PASSWORD = os.getenv("REPLAY_PASSWORD", "replay")
+# requests answered by a frame of the same type; "msg" is matched by its echo
+REPLY_TYPES = {
+    "register",
+    "login",
+    "enter",
+    "exit",
+    "create",
+    "join",
+    "leave",
+    "focus",
+    "stats",
+    "search",
+    "msg",
+    "download",
+    "logout",
+}
+
+
+class Session:
+    __slots__ = ("conn_id", "start", "frames")
+
+    def __init__(self, conn_id, start):
+        self.conn_id = conn_id
+        self.start = start
+        self.frames = []  # [seconds, message]
+
+
+def load_sessions(path) -> list[Session]:
+    sessions = {}
+    for kind, conn_id, seconds, payload in read_capture(path):
+        if kind == OPEN:
+            sessions[conn_id] = Session(conn_id, seconds)
+            continue
+        session = sessions.get(conn_id)
+        if session is None or kind == CLOSE:
+            continue
+        if kind == FRAME:
+            message = payload
+            data = message.get("data") or {}
+            if message.get("type") in ("register", "login"):
+                message["data"] = data = {**data, "password": REPLAY_PASSWORD}
+            if message.get("type") == "login":
+                session.frames.append([seconds, {"type": "register", "data": {**data}}])
+            session.frames.append([seconds, message])
+        elif kind == SESSION and session.frames:
+            # the token is gone, a resume is replayed as a login of its user
+            seconds, message = session.frames[-1]
+            if message.get("type") == "resume":
+                data = {"username": payload, "password": REPLAY_PASSWORD}
+                if "compress" in (message.get("data") or {}):
+                    data["compress"] = message["data"]["compress"]
+                session.frames[-1:] = [
+                    [seconds, {"type": "register", "data": dict(data)}],
+                    [seconds, {"type": "login", "data": data}],
+                ]
+    return sorted(sessions.values(), key=lambda session: session.start)
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # type -> [seconds]
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+    def to_dict(self, duration) -> dict:
+        latency = {}
+        for type, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            latency[type] = {
+                "count": len(samples),
+                "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+                "p50_ms": percentile_ms(samples, 0.5),
+                "p99_ms": percentile_ms(samples, 0.99),
+            }
+        return {
+            "duration_s": round(duration, 3),
+            "sent": self.sent,
+            "received": self.received,
+            "sent_per_s": round(self.sent / duration, 1),
+            "received_per_s": round(self.received / duration, 1),
+            "errors": self.errors,
+            "latency": latency,
+        }
+
+
+class Replayer:
+    def __init__(self, session: Session, args, origin, results: Results):
+        self.session = session
+        self.args = args
+        self.origin = origin  # perf_counter at which the capture's t=0 replays
+        self.results = results
+        self.conn = None
+        self.username = None
+        self.compress = False
+        self.waiting = defaultdict(deque)  # type -> send times, oldest first
+        self.lock = threading.Lock()
+
+    def _sleep_until(self, seconds):
+        delay = self.origin + seconds / self.args.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _connect(self):
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        s = socket.create_connection((self.args.host, self.args.port))
+        return context.wrap_socket(s, server_hostname=self.args.host)
+
+    def run(self):
+        self._sleep_until(self.session.start)
+        try:
+            self.conn = self._connect()
+        except OSError as e:
+            print(f"connection {self.session.conn_id}: {e}")
+            with self.results.lock:
+                self.results.errors += 1
+            return
+        reader = threading.Thread(target=self._read_loop, daemon=True)
+        reader.start()
+        try:
+            for seconds, message in self.session.frames:
+                self._sleep_until(seconds)
+                self._send(message)
+            # give the last replies a chance before hanging up
+            deadline = time.perf_counter() + self.args.linger
+            while time.perf_counter() < deadline and any(self.waiting.values()):
+                time.sleep(0.01)
+        except OSError as e:
+            print(f"connection {self.session.conn_id}: {e}")
+            with self.results.lock:
+                self.results.errors += 1
+        finally:
+            self.conn.close()
+
+    def _send(self, message):
+        type = message.get("type")
+        if type == "login":
+            self.username = message["data"]["username"]
+        data = encode_frame(message, self.compress)
+        with self.lock:
+            if type in REPLY_TYPES:
+                self.waiting[type].append(time.perf_counter())
+        self.conn.sendall(data)
+        with self.results.lock:
+            self.results.sent += 1
+
+    def _recv_exactly(self, n):
+        buffer = bytearray()
+        while len(buffer) < n:
+            data = self.conn.recv(n - len(buffer))
+            if not data:
+                return None
+            buffer += data
+        return buffer
+
+    def _read_loop(self):
+        try:
+            while True:
+                header = self._recv_exactly(4)
+                if header is None:
+                    return
+                length, compressed = parse_header(header)
+                payload = self._recv_exactly(length)
+                if payload is None:
+                    return
+                self._received(decode_payload(payload, compressed))
+        except OSError:
+            return
+
+    def _received(self, message):
+        now = time.perf_counter()
+        type = message.get("type")
+        data = message.get("data") or {}
+        if type in ("login", "resume") and message.get("status") == "ok":
+            self.compress = data.get("compress") == "zlib"
+        # someone else's chat message is traffic, not an answer
+        own = type != "msg" or message.get("status") != "ok"
+        own = own or data.get("from") == self.username
+        sent = None
+        with self.lock:
+            if own and self.waiting[type]:
+                sent = self.waiting[type].popleft()
+        with self.results.lock:
+            self.results.received += 1
+            if sent is not None:
+                self.results.latencies[type].append(now - sent)
+
+
+def run(args):
+    sessions = load_sessions(args.capture)
+    frames = sum(len(session.frames) for session in sessions)
+    print(f"Replaying {len(sessions)} connections, {frames} frames at {args.speed}x")
+    results = Results()
+    origin = time.perf_counter() + 0.5  # time to start every thread
+    threads = [
+        threading.Thread(target=Replayer(session, args, origin, results).run)
+        for session in sessions
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = {
+        "capture": args.capture,
+        "speed": args.speed,
+        "connections": len(sessions),
+        **results.to_dict(time.perf_counter() - origin),
+    }
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_diff(json.load(f), report)
+
+
+def print_report(report):
+    print(
+        f"{report['connections']} connections in {report['duration_s']} s, "
+        f"sent {report['sent']} ({report['sent_per_s']}/s), "
+        f"received {report['received']} ({report['received_per_s']}/s), "
+        f"{report['errors']} errors"
+    )
+    for type, stats in report["latency"].items():
+        print(
+            f"  {type:10s} {stats['count']:7d}   p50 {stats['p50_ms']:8.2f} ms"
+            f"   p99 {stats['p99_ms']:8.2f} ms   mean {stats['mean_ms']:8.2f} ms"
+        )
+
+
+def _change(old, new) -> str:
+    if not old:
+        return "     n/a"
+    return f"{(new - old) / old * 100:+7.1f}%"
+
+
+def print_diff(base, new):
+    print(f"Compared with {base['capture']} at {base['speed']}x:")
+    for key in ("sent_per_s", "received_per_s"):
+        print(
+            f"  {key:16s} {base[key]:10.1f} -> {new[key]:10.1f}"
+            f"  {_change(base[key], new[key])}"
+        )
+    for type in sorted(set(base["latency"]) | set(new["latency"])):
+        old = base["latency"].get(type)
+        cur = new["latency"].get(type)
+        if old is None or cur is None:
+            print(f"  {type:10s} only in {'new' if old is None else 'base'}")
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            print(
+                f"  {type:10s} {key:6s} {old[key]:10.2f} -> {cur[key]:10.2f}"
+                f"  {_change(old[key], cur[key])}"
+            )
+
+
+def diff(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print_diff(base, new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured server traffic")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay a capture against a server")
+    run_parser.add_argument("capture")
+    run_parser.add_argument("--host", default=os.getenv("HOST") or "127.0.0.1")
+    run_parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "65432")))
+    run_parser.add_argument(
+        "--speed", type=float, default=1.0, help="1 is real time, 10 is ten times"
+    )
+    run_parser.add_argument(
+        "--linger", type=float, default=2.0, help="seconds to wait for last replies"
+    )
+    run_parser.add_argument("--out", help="write the report as JSON")
+    run_parser.add_argument("--baseline", help="report to compare against")
+    run_parser.set_defaults(handler=run)
+
+    diff_parser = commands.add_parser("diff", help="compare two saved reports")
+    diff_parser.add_argument("base")
+    diff_parser.add_argument("new")
+    diff_parser.set_defaults(handler=diff)
+
+    args = parser.parse_args()
+    if getattr(args, "speed", 1.0) <= 0:
+        parser.error("--speed must be positive")
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import heapq
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+TOKEN_RE = re.compile(r"\w+")
+# rough cost of one entry besides its text: tuple, ints, posting slots
+ENTRY_OVERHEAD = 120
+POSTING_OVERHEAD = 16
+
+
+def tokenize(text: str) -> set[str]:
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+class RoomHistory:
+    # Recent public messages of one room in a ring buffer bounded by bytes,
+    # plus an inverted index token -> message ids. Ids only grow, so the
+    # oldest entry is always at the head of each of its posting lists and
+    # eviction is O(tokens of that message).
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = deque()  # (id, sender, text, time, size, tokens)
+        self.index = {}  # token -> deque of ids
+        self.by_id = {}  # id -> entry
+        self.size = 0
+        self.next_id = 1
+
+    def add(self, sender, text, created):
+        tokens = tokenize(text)
+        size = ENTRY_OVERHEAD + len(sender) + len(text) + POSTING_OVERHEAD * len(tokens)
+        entry = (self.next_id, sender, text, created, size, tokens)
+        self.next_id += 1
+        self.entries.append(entry)
+        self.by_id[entry[0]] = entry
+        for token in tokens:
+            self.index.setdefault(token, deque()).append(entry[0])
+        self.size += size
+        while self.size > self.budget and self.entries:
+            self._evict()
+
+    def _evict(self):
+        message_id, _, _, _, size, tokens = self.entries.popleft()
+        del self.by_id[message_id]
+        for token in tokens:
+            postings = self.index[token]
+            postings.popleft()
+            if not postings:
+                del self.index[token]
+        self.size -= size
+
+    def search(self, query, page, page_size) -> tuple[list[dict], int]:
+        # rank by number of query tokens matched, newest first on ties
+        scores = {}
+        for token in tokenize(query):
+            for message_id in self.index.get(token, ()):
+                scores[message_id] = scores.get(message_id, 0) + 1
+        ranked = heapq.nsmallest(
+            (page + 1) * page_size,
+            scores.items(),
+            key=lambda item: (-item[1], -item[0]),
+        )
+        hits = []
+        for message_id, score in ranked[page * page_size :]:
+            _, sender, text, created, _, _ = self.by_id[message_id]
+            hits.append(
+                {
+                    "id": message_id,
+                    "from": sender,
+                    "text": text,
+                    "time": created,
+                    "score": score,
+                }
+            )
+        return hits, len(scores)
+
+
+class SearchIndex:
+    # Per-room histories, updated by one indexer thread so the room workers
+    # only pay for a queue put on the broadcast path.
+    def __init__(self, room_budget=256 * 1024):
+        self.room_budget = room_budget
+        self.rooms = {}  # room_name -> RoomHistory
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        threading.Thread(target=self._index_loop, daemon=True).start()
+
+    def add(self, room, sender, text):
+        self.pending.put((room, sender, text, time.time()))
+
+    def _index_loop(self):
+        while True:
+            room, sender, text, created = self.pending.get()
+            if room is None:
+                # drop marker, see drop_room
+                with self.lock:
+                    self.rooms.pop(sender, None)
+                continue
+            with self.lock:
+                history = self.rooms.get(room)
+                if history is None:
+                    history = self.rooms[room] = RoomHistory(self.room_budget)
+                history.add(sender, text, created)
+
+    def drop_room(self, room):
+        # queued behind the room's last messages, so nothing re-creates it
+        self.pending.put((None, room, None, None))
+
+    def search(self, room, query, page=0, page_size=20) -> tuple[list[dict], int]:
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None:
+                return [], 0
+            return history.search(query, page, page_size)
@@ -3,23 +3,75 @@ import os
 import threading
 from dotenv import load_dotenv
 import ssl
-import json
-
-from sqlalchemy import (
-    create_engine,
-    MetaData,
-    Table,
-    Column,
-    Integer,
-    String,
+import argparse
+import secrets
+import time
+import random
+import queue
+import base64
+
+from utils import (
+    hash_password,
+    hash_token,
+    generate_salt,
+    make_message,
+    parse_message,
+    Frame,
+    parse_header,
+    decode_payload,
+    compression_stats,
+    FrameError,
+    MAX_FRAME,
 )
-from utils import hash_password, generate_salt, Message
-from typing import Optional, Any
+from attachments import AttachmentStore, AttachmentError
+from capture import Capture
+from fairness import Share, fairness_report
+from outbox import Outbox, OutboxFull, outbox_stats, CONTROL, DIRECT, ROOM, BULK
+from presence import PresenceHub
+from search import SearchIndex
+from snapshot import Session, Snapshot, SnapshotError, load_snapshot, write_snapshot
+from typing import Optional, Any, TYPE_CHECKING
 import traceback
+import sys
+
+if TYPE_CHECKING:
+    from inbox import Inbox
+    from messages import Message
 
 
 load_dotenv()
 
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "chatdata.snap")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))
+RESUME_TOKEN_TTL = float(os.getenv("RESUME_TOKEN_TTL", "600"))
+HANDOFF_PATH = os.getenv("HANDOFF_PATH", "chatserver.sock")
+RECONNECT_WINDOW = float(os.getenv("RECONNECT_WINDOW", "5"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "5"))
+# on top of the drain, for the old server's inbox flush and final snapshot
+HANDOFF_GRACE = float(os.getenv("HANDOFF_GRACE", "10"))
+# a client that connects and never finishes TLS is dropped after this long
+HANDSHAKE_TIMEOUT = float(os.getenv("HANDSHAKE_TIMEOUT", "10"))
+# usernames and room names, in characters; snapshots store them with a u16
+# byte length, so this must stay well under 65535 / 4
+MAX_NAME_LENGTH = int(os.getenv("MAX_NAME_LENGTH", "64"))
+ROOM_IDLE_TIMEOUT = float(os.getenv("ROOM_IDLE_TIMEOUT", "300"))
+ROOM_BATCH_SIZE = int(os.getenv("ROOM_BATCH_SIZE", "64"))
+THREAD_STACK_SIZE = int(os.getenv("THREAD_STACK_SIZE", str(512 * 1024)))
+INBOX_LIMIT = int(os.getenv("INBOX_LIMIT", "1000"))
+INBOX_PAGE_SIZE = int(os.getenv("INBOX_PAGE_SIZE", "500"))
+SEARCH_ROOM_BUDGET = int(os.getenv("SEARCH_ROOM_BUDGET", str(256 * 1024)))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+PRESENCE_TICK = float(os.getenv("PRESENCE_TICK", "0.5"))
+TYPING_TTL = float(os.getenv("TYPING_TTL", "4"))
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+ATTACHMENT_MAX_SIZE = int(os.getenv("ATTACHMENT_MAX_SIZE", str(100 * 1024 * 1024)))
+TRANSFER_CHUNK_SIZE = int(os.getenv("TRANSFER_CHUNK_SIZE", str(32 * 1024)))
+TRANSFER_WINDOW = int(os.getenv("TRANSFER_WINDOW", "8"))  # chunks in flight
+# uploads plus downloads one connection may have going at once
+TRANSFER_MAX_ACTIVE = int(os.getenv("TRANSFER_MAX_ACTIVE", "4"))
+# bump whenever a table is added or changed, startup skips create_all otherwise
+SCHEMA_VERSION = 2
+
 
 class RoomError(Exception):
     pass
@@ -30,44 +82,202 @@ class MessageFactory:
     def ok(
         type: str, data: Optional[dict[str, Any]] = None, message: Optional[str] = None
     ) -> dict:
-        return Message(type=type, status="ok", message=message, data=data).to_dict()
+        return make_message(
+            type=type, status="ok", message=message, data=data
+        ).to_dict()
 
     @staticmethod
-    def error(type: str, message: str) -> dict:
-        return Message(type=type, status="error", message=message).to_dict()
+    def error(type: str, message: str, data: Optional[dict[str, Any]] = None) -> dict:
+        return make_message(
+            type=type, status="error", message=message, data=data
+        ).to_dict()
 
     @staticmethod
     def push():
         pass
 
 
+class Room:
+    # A room owns its member list and a worker thread. Everything pushed to the
+    # room goes through its inbox, so all members see one order and fan-out
+    # never runs on the sender's thread.
+    def __init__(self, name, chat_data: "ChatData", persistent=False):
+        self.name = name
+        self.chat_data = chat_data
+        self.persistent = persistent  # never evicted when empty
+        self.members = {}  # username -> None, ordered set with O(1) removal
+        self.lock = threading.Lock()
+        self.closed = False
+        self.inbox = queue.Queue()  # (Frame | None, recipients | None, priority)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def add(self, username):
+        with self.lock:
+            if self.closed:
+                raise RoomError(f"Destination room {self.name} not found")
+            if username in self.members:
+                raise RoomError(f"You are already in {self.name}")
+            self.members[username] = None
+
+    def remove(self, username):
+        with self.lock:
+            self.members.pop(username, None)
+
+    def get_members(self) -> list:
+        with self.lock:
+            return list(self.members)
+
+    def post(self, frame: Frame, recipients=None, priority=ROOM):
+        # recipients=None means every member at delivery time
+        self.inbox.put((frame, recipients, priority))
+
+    def post_state(self):
+        self.inbox.put((None, None, BULK))
+
+    def state_frame(self) -> Frame:
+        if self.name == "lobby":
+            return Frame(MessageFactory.ok("list", self.chat_data.get_room_info()))
+        return Frame(MessageFactory.ok("list_room", {self.name: self.get_members()}))
+
+    def _run(self):
+        while True:
+            try:
+                item = self.inbox.get(timeout=ROOM_IDLE_TIMEOUT)
+            except queue.Empty:
+                if self.chat_data.evict_room(self):
+                    return
+                continue
+            batch = [item]
+            while len(batch) < ROOM_BATCH_SIZE:
+                try:
+                    batch.append(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                print(f"room {self.name} delivery error {e}")
+
+    def _deliver(self, batch):
+        members = self.get_members()
+        outgoing = {}  # username -> [(priority, Frame)], one enqueue per member
+        state_changed = False
+        for frame, recipients, priority in batch:
+            if frame is None:
+                state_changed = True
+                continue
+            for username in members if recipients is None else recipients:
+                outgoing.setdefault(username, []).append((priority, frame))
+        if state_changed:
+            # any number of state notifications in a batch collapse into one
+            frame = self.state_frame()
+            for username in members:
+                outgoing.setdefault(username, []).append((BULK, frame))
+        for username, items in outgoing.items():
+            handler = self.chat_data.get_handler(username)
+            if handler:
+                handler.enqueue(items)
+                if handler.subscriptions:
+                    unread = sum(
+                        1
+                        for _, frame in items
+                        if frame.message["type"] == "msg"
+                        and frame.message["data"]["from"] != username
+                    )
+                    if unread:
+                        handler.count_unread(self.name, unread)
+        # index after fan-out, the indexer thread does the actual work
+        for frame, recipients, _ in batch:
+            if frame is not None and recipients is None:
+                if frame.message["type"] == "msg":
+                    data = frame.message["data"]
+                    self.chat_data.search.add(self.name, data["from"], data["text"])
+
+
 class ChatData:
     def __init__(self):
-        self.online_users = {}  # username -> socket
-        self.chatrooms = {"lobby": []}  # room_name -> [user1, user2, ...]
-        self.chatrooms["example"] = []  # for demo
+        self.online_users = {}  # username -> ClientHandler
+        self.chatrooms = {}  # room_name -> Room
+        self.chatrooms["lobby"] = Room("lobby", self, persistent=True)
+        self.chatrooms["example"] = Room("example", self, persistent=True)  # demo
+        self.resume_tokens = {}  # hash_token(token) -> [username, room, expires]
+        self.session_tokens = {}  # username -> hash_token(token)
+        self.connections = set()  # live ClientHandler, authenticated or not
+        self.search = SearchIndex(SEARCH_ROOM_BUDGET)
+        self.presence = PresenceHub(self.publish_presence, PRESENCE_TICK, TYPING_TTL)
+        self.attachments = AttachmentStore(ATTACHMENT_DIR, ATTACHMENT_MAX_SIZE)
+        self.closing = False
+        self.capture: Capture | None = None  # set by --capture
         self.lock = threading.RLock()
+        # bumped when the rooms or a session's token or room change, lets
+        # snapshots skip clean state; membership is not persisted
+        self.version = 0
+        self.snapshot_version = -1
 
-        DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+pysqlite:///chatapp.db")
-        self.engine = create_engine(DATABASE_URL)
-        metadata_obj = MetaData()
-        self.users = Table(
-            "users",
-            metadata_obj,
-            Column("id", Integer, primary_key=True),
-            Column("username", String, nullable=False),
-            Column("password", String, nullable=False),
-            Column("salt", String, nullable=False),
-        )
-        metadata_obj.create_all(self.engine)
+        # opened on first use (or by warm_up), SQLAlchemy is slow to import
+        self.engine = None
+        self.users = None
+        self._inbox = None
+        self.db_lock = threading.Lock()
+
+    def open_database(self):
+        with self.db_lock:
+            if self.engine is not None:
+                return
+            from sqlalchemy import (
+                create_engine,
+                MetaData,
+                Table,
+                Column,
+                Integer,
+                String,
+                select,
+                delete,
+                insert,
+            )
+            from sqlalchemy.exc import DBAPIError
+            from inbox import Inbox
+
+            DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+pysqlite:///chatapp.db")
+            engine = create_engine(DATABASE_URL)
+            metadata_obj = MetaData()
+            self.users = Table(
+                "users",
+                metadata_obj,
+                Column("id", Integer, primary_key=True),
+                Column("username", String, nullable=False),
+                Column("password", String, nullable=False),
+                Column("salt", String, nullable=False),
+            )
+            self._inbox = Inbox(engine, metadata_obj, limit=INBOX_LIMIT)
+            schema = Table("schema_version", metadata_obj, Column("version", Integer))
+            try:
+                with engine.connect() as conn:
+                    version = conn.execute(select(schema.c.version)).scalar()
+            except DBAPIError:
+                version = None
+            if version != SCHEMA_VERSION:
+                metadata_obj.create_all(engine)
+                with engine.begin() as conn:
+                    conn.execute(delete(schema))
+                    conn.execute(insert(schema).values(version=SCHEMA_VERSION))
+            self.engine = engine
+
+    @property
+    def inbox(self) -> "Inbox":
+        self.open_database()
+        return self._inbox
 
     def is_registered(self, username: str):
+        self.open_database()
         stmt = self.users.select().where(self.users.c.username == username)
         with self.engine.connect() as conn:
             result = conn.execute(stmt).fetchone()
             return result is not None
 
     def add_user(self, username, password):
+        self.open_database()
         salt = generate_salt()
         stmt = self.users.insert().values(
             username=username, password=hash_password(password, salt), salt=salt
@@ -77,6 +287,7 @@ class ChatData:
             conn.commit()
 
     def check_password(self, username, password):
+        self.open_database()
         stmt = self.users.select().where(self.users.c.username == username)
         with self.engine.connect() as conn:
             result = conn.execute(stmt).fetchone()
@@ -88,17 +299,53 @@ class ChatData:
                 else False
             )
 
-    def add_online_user(self, username, socket):
+    def add_connection(self, handler):
         with self.lock:
-            self.online_users[username] = socket
+            self.connections.add(handler)
 
-    def logout(self, username, chatroom):
+    def remove_connection(self, handler):
         with self.lock:
-            if username:
-                self.online_users.pop(username, None)
-            if chatroom and chatroom in self.chatrooms:
-                if username in self.chatrooms[chatroom]:
-                    self.chatrooms[chatroom].remove(username)
+            self.connections.discard(handler)
+
+    def fairness(self, handler) -> dict:
+        with self.lock:
+            shares = [connection.share for connection in self.connections]
+        return fairness_report(shares, handler.share)
+
+    def add_online_user(self, username, handler) -> list:
+        # A reconnect can beat the teardown of the user's old connection. The
+        # new session takes over: the old handler leaves every room here and
+        # is closed, returns the rooms it was in.
+        with self.lock:
+            previous = self.online_users.get(username)
+            self.online_users[username] = handler
+            if previous is None or previous is handler:
+                return []
+            rooms = previous.rooms()
+            self._remove_member(username, rooms)
+        previous.close()
+        return rooms
+
+    def logout(self, username, rooms, handler) -> bool:
+        # False when a newer session of the user already took over, its
+        # membership is not ours to remove
+        with self.lock:
+            if not username or self.online_users.get(username) is not handler:
+                return False
+            del self.online_users[username]
+            self._remove_member(username, rooms)
+        return True
+
+    def _remove_member(self, username, rooms):
+        # under self.lock, room locks are never held while taking it
+        for room_name in rooms:
+            room = self.chatrooms.get(room_name)
+            if room:
+                room.remove(username)
+
+    def get_room(self, room_name) -> Room | None:
+        with self.lock:
+            return self.chatrooms.get(room_name)
 
     def enter_room(self, username, destination, source=None):
         with self.lock:
@@ -107,39 +354,179 @@ class ChatData:
 
             if destination not in self.chatrooms:
                 raise RoomError(f"Destination room {destination} not found")
+            target = self.chatrooms[destination]
+            origin = self.chatrooms.get(source) if source else None
 
-            if username in self.chatrooms[destination]:
-                raise RoomError(f"You are already in {destination}")
+        # membership lives in the rooms, the registry lock is not held here
+        target.add(username)
+        if origin:
+            origin.remove(username)
+        self.set_resume_room(username, target.name)
 
-            if source and username in self.chatrooms[source]:
-                self.chatrooms[source].remove(username)
-            self.chatrooms[destination].append(username)
+    def set_resume_room(self, username, room_name):
+        with self.lock:
+            # remember where the user is, a resumed session returns there
+            record = self.resume_tokens.get(self.session_tokens.get(username))
+            if record and record[1] != room_name:
+                record[1] = room_name
+                self.version += 1
+
+    def join_room(self, username, room_name) -> str:
+        # an extra subscription, the user stays in every room already joined
+        room = self.get_room(room_name)
+        if room is None:
+            raise RoomError(f"Destination room {room_name} not found")
+        room.add(username)
+        return room.name
+
+    def leave_room(self, username, room_name):
+        room = self.get_room(room_name)
+        if room:
+            room.remove(username)
 
     def create_room(self, room_name):
+        if not isinstance(room_name, str) or len(room_name) > MAX_NAME_LENGTH:
+            raise RoomError(f"Room names are at most {MAX_NAME_LENGTH} characters")
         with self.lock:
             if room_name in self.chatrooms:
                 raise RoomError(f"{room_name} already exists")
-            self.chatrooms[room_name] = []
+            # interned, so every member list and handler shares one string
+            room_name = sys.intern(room_name)
+            self.chatrooms[room_name] = Room(room_name, self)
+            self.version += 1
+
+    def evict_room(self, room: Room) -> bool:
+        if room.persistent:
+            return False
+        with self.lock, room.lock:
+            if room.members or room.closed:
+                return False
+            room.closed = True
+            if self.chatrooms.get(room.name) is room:
+                del self.chatrooms[room.name]
+            self.version += 1
+        self.search.drop_room(room.name)
+        print(f"Evicted idle room {room.name}")
+        self.chatrooms["lobby"].post_state()
+        return True
+
+    def publish_presence(self, room_name, users):
+        room = self.get_room(room_name)
+        if room:
+            room.post(
+                Frame(
+                    MessageFactory.ok("presence", {"room": room_name, "users": users})
+                ),
+                priority=BULK,
+            )
 
     def get_room_users(self, room_name) -> list:
+        room = self.get_room(room_name)
+        return room.get_members() if room else []
+
+    def get_handler(self, username):
+        # no lock: every room worker looks up each recipient here, and a single
+        # dict lookup is atomic; the writers hold self.lock among themselves
+        return self.online_users.get(username)
+
+    def get_room_info(self, room_name=None):
+        if room_name:
+            return {room_name: self.get_room_users(room_name)}
         with self.lock:
-            return list(self.chatrooms.get(room_name, []))
+            rooms = list(self.chatrooms.values())
+        # return a copy insead of the objects themselves
+        return {room.name: room.get_members() for room in rooms}
 
-    def get_socket(self, username):
+    def issue_token(self, username, room) -> str:
+        # room is where the session is now, a resume returns there
+        token = secrets.token_urlsafe(24)
         with self.lock:
-            return self.online_users.get(username, None)
+            # one live token per user, a new login invalidates the old one
+            self.revoke_tokens(username)
+            key = hash_token(token)
+            self.resume_tokens[key] = [username, room, time.time() + RESUME_TOKEN_TTL]
+            self.session_tokens[username] = key
+            self.version += 1
+        return token
 
-    def get_room_info(self, room_name=None):
+    def revoke_tokens(self, username):
+        with self.lock:
+            key = self.session_tokens.pop(username, None)
+            if self.resume_tokens.pop(key, None):
+                self.version += 1
+
+    def consume_token(self, token) -> tuple[str, str] | None:
+        if not isinstance(token, str):
+            return None
+        with self.lock:
+            record = self.resume_tokens.pop(hash_token(token), None)
+            if record is None:
+                return None
+            username, room, expires = record
+            self.session_tokens.pop(username, None)
+            self.version += 1
+            if expires < time.time():
+                return None
+            return username, room
+
+    def snapshot(self, path) -> bool:
+        with self.lock:
+            if self.version == self.snapshot_version:
+                return False
+            version = self.version
+            now = time.time()
+            # accounts registered before MAX_NAME_LENGTH may have longer
+            # names, they only lose warm resume
+            sessions = [
+                Session(key, username, room, expires)
+                for key, (username, room, expires) in self.resume_tokens.items()
+                if expires > now and len(username) <= MAX_NAME_LENGTH
+            ]
+            rooms = list(self.chatrooms)
+        write_snapshot(path, Snapshot(rooms, sessions))
         with self.lock:
-            if not room_name:
-                # return a copy insead of the object itself
-                return {room: list(users) for room, users in self.chatrooms.items()}
-            if room_name not in self.chatrooms:
-                return {room_name: []}
-            return {room_name: list(self.chatrooms[room_name])}
+            self.snapshot_version = version
+        return True
+
+    def restore(self, path) -> bool:
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            return False
+        with self.lock:
+            for room in snapshot.rooms:
+                if room not in self.chatrooms:
+                    room = sys.intern(room)
+                    self.chatrooms[room] = Room(room, self)
+            for session in snapshot.sessions:
+                username = sys.intern(session.username)
+                self.resume_tokens[session.token_hash] = [
+                    username,
+                    sys.intern(session.room),
+                    session.expires,
+                ]
+                self.session_tokens[username] = session.token_hash
+            self.snapshot_version = self.version
+        return True
 
 
 class ClientHandler:
+    # one per connection, kept small: no __dict__, names interned
+    __slots__ = (
+        "conn",
+        "addr",
+        "username",
+        "chatroom",
+        "state",
+        "active",
+        "chat_data",
+        "compress",
+        "outbox",
+        "transfers",
+        "subscriptions",
+        "subscriptions_lock",
+        "share",
+    )
+
     def __init__(self, conn, addr, chat_data: ChatData):
         self.conn = conn
         self.addr = addr
@@ -148,10 +535,34 @@ class ClientHandler:
         self.state = "auth"
         self.active = True
         self.chat_data = chat_data
+        self.compress = False  # negotiated at login
+        self.outbox = Outbox(conn)  # written by its own thread, everyone queues
+        self.transfers = None  # attachment id -> Upload | Download, on first use
+        # rooms joined besides the focused self.chatroom -> unread messages
+        self.subscriptions = None
+        # room workers count unread messages while the handler joins, leaves
+        # and refocuses, both sides change self.subscriptions under this
+        self.subscriptions_lock = threading.Lock()
+        self.share = Share()  # handler CPU and frames, see fairness.py
 
     def run(self):
+        self.chat_data.add_connection(self)
+        if self.chat_data.capture:
+            self.chat_data.capture.open(self)
+        entered = "auth"
         try:
             while self.active:
+                if self.state != entered:
+                    # tell the room once per state change, not on every frame,
+                    # so presence and typing traffic never triggers a list push
+                    entered = self.state
+                    if self.state == "lobby":
+                        self.notify_lobby_state()
+                    elif self.state == "chat":
+                        self.notify_room_state(self.chatroom)
+                # each state handles one frame; the time blocked in recv is
+                # not CPU time, so a quiet connection is charged almost nothing
+                started = time.thread_time()
                 if self.state == "auth":
                     self.state = self.auth()
                 elif self.state == "lobby":
@@ -161,27 +572,63 @@ class ClientHandler:
                 else:
                     print("Unknown state")
                     break
+                self.share.charge(time.thread_time() - started)
         except Exception as e:
             print(f"run error {e}")
             traceback.print_exc()
         finally:
             last_username = self.username
-            last_room = self.chatroom
-            self.chat_data.logout(last_username, last_room)
-            if last_username:
-                self.notify_lobby_state()
-                if last_room and last_room != "lobby":
-                    self.notify_room_state(last_room)
-            self.conn.close()
+            with self.subscriptions_lock:
+                last_rooms = self.rooms()
+                self.subscriptions = None
+            # an evicted connection has nothing left to undo
+            if self.chat_data.logout(last_username, last_rooms, self):
+                self.chat_data.presence.forget(last_username, last_rooms)
+                # during a handoff everyone is leaving, nobody needs the updates
+                if not self.chat_data.closing:
+                    self.notify_lobby_state()
+                    for room_name in last_rooms:
+                        if room_name != "lobby":
+                            self.notify_room_state(room_name)
+            self.close_transfers()
+            self.outbox.close()
+            with self.outbox.tls:
+                self.conn.close()
             self.active = False
+            self.chat_data.remove_connection(self)
+            if self.chat_data.capture:
+                self.chat_data.capture.close(self)
             print(f"{last_username} cleanup")
 
-    def send(self, message_dict, socket=None):
+    def close(self):
+        self.active = False
+        self.outbox.shutdown()
+
+    def send(self, message, target=None, priority=CONTROL):
+        # message is a dict or a Frame already encoded for a fan-out
+        frame = message if isinstance(message, Frame) else Frame(message)
+        (self if target is None else target).send_frame(frame, priority)
+
+    def send_frame(self, frame: Frame, priority=CONTROL):
+        self.enqueue([(priority, frame)])
+
+    def send_page_change(self, message):
+        # replies that take the client to another page (enter, exit, logout)
+        # must not overtake frames still queued for the page being left
+        self.enqueue([(CONTROL, Frame(message))], barrier=True)
+
+    def enqueue(self, items: list[tuple[int, Frame]], barrier=False):
+        # may return before the bytes are written, see Outbox
         try:
-            data = json.dumps(message_dict).encode("utf-8")
-            header = len(data).to_bytes(4, byteorder="big")
-            target = self.conn if socket is None else socket
-            target.sendall(header + data)
+            self.outbox.put_many(
+                [(priority, frame.encode(self.compress)) for priority, frame in items],
+                barrier,
+            )
+        except OutboxFull as e:
+            # a slow consumer, cut it loose instead of buffering for it
+            print(f"{self.username} disconnected, outbox full: {e}")
+            self.outbox.close()
+            self.close()
         except Exception as e:
             print(f"send error {e}")
             self.active = False
@@ -190,92 +637,479 @@ class ClientHandler:
         header = self.recv_exactly(4)
         if header is None:
             return None
-        length = int.from_bytes(header, "big")
+        length, compressed = parse_header(header)
+        if length > MAX_FRAME or (compressed and not self.compress):
+            # compression is only accepted once negotiated at login
+            print(f"recv error: rejected frame of {length} bytes")
+            self.active = False
+            return None
         payload = self.recv_exactly(length)
         if payload is None:
             return None
-        return json.loads(payload.decode("utf-8"))
+        # checked before the reply goes out, a client waiting for it has
+        # nothing queued yet, a pipelining one has
+        self.share.pipelined = self.outbox.readable()
+        try:
+            message = decode_payload(payload, compressed)
+        except FrameError as e:
+            print(f"recv error {e}")
+            self.active = False
+            return None
+        if self.chat_data.capture:
+            self.chat_data.capture.frame(self, message)
+        return message
 
     def recv_exactly(self, n):
-        buffer = b""
         try:
-            while len(buffer) < n:
-                data = self.conn.recv(n - len(buffer))
-                if not data:
-                    self.active = False
-                    return None
+            data = self.outbox.read(n)
+            if len(data) == n:
+                # common case, and an idle connection holds no buffer at all
+                return data
+            # grow one bytearray in place instead of concatenating bytes
+            buffer = bytearray(data)
+            while data and len(buffer) < n:
+                data = self.outbox.read(n - len(buffer))
                 buffer += data
+            if len(buffer) < n:
+                self.active = False
+                return None
             return buffer
         except Exception as e:
             print(f"recv error {e}")
             self.active = False
 
+    # === Subscriptions ===
+    # A connection is always in its focused room (self.chatroom) and may join
+    # more. Each room routes to its own members only, so a message costs
+    # O(subscribers of that room) however many rooms a connection follows.
+    def rooms(self) -> list:
+        if self.chatroom is None:
+            return []
+        return [self.chatroom, *(self.subscriptions or ())]
+
+    def unread(self) -> dict:
+        return dict(self.subscriptions or {})
+
+    def count_unread(self, room_name, count):
+        # called by the room worker; the room may have been left or focused
+        # since it was looked up, then there is nothing to count
+        with self.subscriptions_lock:
+            if self.subscriptions and room_name in self.subscriptions:
+                self.subscriptions[room_name] += count
+
+    def target_room(self, msg: "Message", data=None) -> str | None:
+        # requests may name one of the joined rooms, the focused one otherwise;
+        # data goes with the error, e.g. the id of a transfer
+        room_name = msg.data.get("room") if msg.data else None
+        if room_name is None or room_name == self.chatroom:
+            return self.chatroom
+        if self.subscriptions and room_name in self.subscriptions:
+            return room_name
+        self.send(MessageFactory.error(msg.type, f"You are not in {room_name}", data))
+        return None
+
+    def join(self, room_name):
+        if room_name == "lobby":
+            self.send(MessageFactory.error("join", "Use exit to go back to the lobby"))
+            return
+        try:
+            room_name = self.chat_data.join_room(self.username, room_name)
+        except RoomError as e:
+            self.send(MessageFactory.error("join", str(e)))
+            return
+        with self.subscriptions_lock:
+            if self.subscriptions is None:
+                self.subscriptions = {}
+            self.subscriptions[room_name] = 0
+        self.send(
+            MessageFactory.ok(
+                "join",
+                {"room": room_name, "unread": self.unread()},
+                f"Welcome to {room_name}",
+            )
+        )
+        self.notify_room_state(room_name)
+        self.send_presence(room_name)
+
+    def leave(self, room_name):
+        if room_name == self.chatroom and self.subscriptions:
+            # focus moves to the room joined first
+            self.focus(next(iter(self.subscriptions)))
+        if not self.subscriptions or room_name not in self.subscriptions:
+            self.send(MessageFactory.error("leave", f"You are not in {room_name}"))
+            return
+        with self.subscriptions_lock:
+            del self.subscriptions[room_name]
+        self.chat_data.leave_room(self.username, room_name)
+        self.chat_data.presence.stop_typing(self.username, room_name)
+        self.notify_room_state(room_name)
+        self.send(
+            MessageFactory.ok(
+                "leave",
+                {"room": room_name, "chatroom": self.chatroom, "unread": self.unread()},
+            )
+        )
+
+    def focus(self, room_name):
+        if self.subscriptions and room_name in self.subscriptions:
+            with self.subscriptions_lock:
+                del self.subscriptions[room_name]
+                self.subscriptions[self.chatroom] = 0
+                self.chatroom = room_name
+            self.chat_data.set_resume_room(self.username, room_name)
+        elif room_name != self.chatroom:
+            self.send(MessageFactory.error("focus", f"You are not in {room_name}"))
+            return
+        self.send(
+            MessageFactory.ok("focus", {"room": room_name, "unread": self.unread()})
+        )
+
+    def leave_subscriptions(self):
+        for room_name in self.subscriptions or ():
+            self.chat_data.leave_room(self.username, room_name)
+            self.chat_data.presence.stop_typing(self.username, room_name)
+            if not self.chat_data.closing:
+                self.notify_room_state(room_name)
+        with self.subscriptions_lock:
+            self.subscriptions = None
+
     def notify_lobby_state(self):
-        info = self.chat_data.get_room_info()
-        for username in self.chat_data.get_room_users("lobby"):
-            socket = self.chat_data.get_socket(username)
-            if socket:
-                self.send(MessageFactory.ok("list", info), socket)
+        self.notify_room_state("lobby")
 
     def notify_room_state(self, room_name):
-        if not room_name:
-            return
-        info = self.chat_data.get_room_info(room_name)
-        for username in self.chat_data.get_room_users(room_name):
-            socket = self.chat_data.get_socket(username)
-            if socket:
-                self.send(MessageFactory.ok("list_room", info), socket)
+        room = self.chat_data.get_room(room_name) if room_name else None
+        if room:
+            room.post_state()
+
+    def send_message(self, sender, receiver, text, attachment=None, room_name=None):
+        room_name = room_name or self.chatroom
 
-    def send_message(self, sender, receiver, text):
+        def payload(to, sender):
+            data = {"to": to, "from": sender, "text": text, "room": room_name}
+            if attachment:
+                data["attachment"] = attachment
+            return data
+
+        room = self.chat_data.get_room(room_name)
+        if room is None:
+            self.send(MessageFactory.error("msg", message=f"{room_name} not found"))
+            return "chat"
         if receiver == "public":
-            room_users = self.chat_data.get_room_users(self.chatroom)
-            for username in room_users:
-                socket = self.chat_data.get_socket(username)
+            room.post(Frame(MessageFactory.ok("msg", payload("public", sender))))
+        else:
+            online = self.chat_data.get_handler(receiver) is not None
+            if not online and self.chat_data.is_registered(receiver):
+                self.chat_data.inbox.put(receiver, self.username, text)
                 self.send(
                     MessageFactory.ok(
-                        "msg", {"to": "public", "from": sender, "text": text}
-                    ),
-                    socket,
+                        "msg",
+                        payload(self.username, self.username),
+                        f"{receiver} is offline, the message will be delivered later",
+                    )
                 )
-        else:
-            if receiver not in self.chat_data.get_room_users(self.chatroom):
+                return "chat"
+            if receiver not in room.get_members():
                 self.send(
                     MessageFactory.error(
-                        "msg", message=f"{receiver} not in {self.chatroom}"
+                        "msg", message=f"{receiver} not in {room_name}"
                     )
                 )
                 return "chat"
-            socket = self.chat_data.get_socket(receiver)
-            if socket:
-                self.send(
-                    MessageFactory.ok(
-                        "msg", {"to": receiver, "from": self.username, "text": text}
-                    ),
-                    socket,
+            if self.chat_data.get_handler(receiver):
+                # through the room worker, but as DIRECT so a private message
+                # can overtake a backlog of room broadcasts on the connection
+                room.post(
+                    Frame(MessageFactory.ok("msg", payload(receiver, self.username))),
+                    (receiver,),
+                    DIRECT,
                 )
                 # send one copy to sender
-                self.send(
-                    MessageFactory.ok(
-                        "msg",
-                        {"to": self.username, "from": self.username, "text": text},
-                    )
+                room.post(
+                    Frame(
+                        MessageFactory.ok("msg", payload(self.username, self.username))
+                    ),
+                    (self.username,),
+                    DIRECT,
                 )
             else:
                 self.send(MessageFactory.error("msg", message=f"{receiver} not exists"))
-            pass
+
+    def send_presence(self, room_name=None):
+        room_name = room_name or self.chatroom
+        users = self.chat_data.presence.snapshot(
+            room_name, self.chat_data.get_room_users(room_name)
+        )
+        if users:
+            self.send(
+                MessageFactory.ok("presence", {"room": room_name, "users": users}),
+                priority=BULK,
+            )
+
+    def set_status(self, msg: "Message"):
+        status = msg.data.get("status") if msg.data else None
+        if status in ("away", "online"):
+            self.chat_data.presence.set_status(self.username, self.rooms(), status)
+
+    def search(self, query, page, room_name):
+        hits, total = self.chat_data.search.search(
+            room_name, query, page, SEARCH_PAGE_SIZE
+        )
+        self.send(
+            MessageFactory.ok(
+                "search",
+                {
+                    "room": room_name,
+                    "query": query,
+                    "page": page,
+                    "total": total,
+                    "hits": hits,
+                },
+            )
+        )
+
+    def send_stats(self):
+        self.send(
+            MessageFactory.ok(
+                "stats",
+                {
+                    "compression": compression_stats.to_dict(),
+                    "outbound": outbox_stats.to_dict(),
+                    "fairness": self.chat_data.fairness(self),
+                },
+            )
+        )
+
+    def deliver_inbox(self):
+        # stream the backlog in pages, rows stay stored until the client acks
+        self.chat_data.inbox.flush()
+        last_id = 0
+        while True:
+            messages = self.chat_data.inbox.fetch(
+                self.username, after_id=last_id, limit=INBOX_PAGE_SIZE
+            )
+            if not messages:
+                return
+            last_id = messages[-1]["id"]
+            self.send(
+                MessageFactory.ok(
+                    "inbox",
+                    {
+                        "messages": messages,
+                        "last_id": last_id,
+                        "more": len(messages) == INBOX_PAGE_SIZE,
+                    },
+                ),
+                priority=BULK,
+            )
+            if len(messages) < INBOX_PAGE_SIZE or not self.active:
+                return
+
+    def ack_inbox(self, msg: "Message"):
+        if msg.data is not None and self.username:
+            self.chat_data.inbox.ack(self.username, int(msg.data["last_id"]))
+
+    # === Attachments ===
+    # Uploads and downloads are split into TRANSFER_CHUNK_SIZE chunks with at
+    # most TRANSFER_WINDOW of them unacknowledged, so a transfer never holds
+    # more than a window in memory and chat frames get through in between.
+    # Every transfer error carries the transfer's id, a client may run several.
+    def transfer_slot(self, kind, id) -> bool:
+        # restarting the same transfer replaces it and needs no new slot
+        if not self.transfers or (kind, id) in self.transfers:
+            return True
+        if len(self.transfers) < TRANSFER_MAX_ACTIVE:
+            return True
+        self.send(
+            MessageFactory.error(
+                kind,
+                f"At most {TRANSFER_MAX_ACTIVE} transfers at a time",
+                {"id": id},
+            )
+        )
+        return False
+
+    def start_upload(self, msg: "Message"):
+        id = str(msg.data["sha256"]).lower()
+        name = os.path.basename(str(msg.data["name"])) or "file"
+        size = int(msg.data["size"])
+        to = msg.data.get("to", "public")
+        room_name = self.target_room(msg, {"id": id})
+        if room_name is None:
+            return
+        if to != "public" and to not in self.chat_data.get_room_users(room_name):
+            self.send(
+                MessageFactory.error("upload", f"{to} not in {room_name}", {"id": id})
+            )
+            return
+        store = self.chat_data.attachments
+        try:
+            if store.size(id) == size:
+                # same content was uploaded before, nothing to transfer
+                self.send(MessageFactory.ok("upload", {"id": id, "complete": True}))
+                self.send_message(
+                    self.username,
+                    to,
+                    name,
+                    {"id": id, "name": name, "size": size},
+                    room_name,
+                )
+                return
+            if not self.transfer_slot("upload", id):
+                return
+            upload = store.start_upload(id, name, size, room_name, to)
+        except AttachmentError as e:
+            self.send(MessageFactory.error("upload", str(e), {"id": id}))
+            return
+        if self.transfers is None:
+            self.transfers = {}
+        previous = self.transfers.pop(("upload", id), None)
+        if previous:
+            previous.abort()
+        self.transfers[("upload", id)] = upload
+        if upload.done:
+            self.finish_upload(upload)
+            return
+        self.send(
+            MessageFactory.ok(
+                "upload",
+                {
+                    "id": id,
+                    "offset": 0,
+                    "chunk_size": TRANSFER_CHUNK_SIZE,
+                    "window": TRANSFER_WINDOW,
+                },
+            )
+        )
+
+    def upload_chunk(self, msg: "Message"):
+        id = msg.data["id"]
+        upload = self.transfers.get(("upload", id)) if self.transfers else None
+        if upload is None:
+            self.send(
+                MessageFactory.error("upload_chunk", "Unknown upload", {"id": id})
+            )
+            return
+        try:
+            upload.write(int(msg.data["offset"]), base64.b64decode(msg.data["data"]))
+        except (AttachmentError, ValueError) as e:
+            del self.transfers[("upload", id)]
+            upload.abort()
+            self.send(MessageFactory.error("upload_chunk", str(e), {"id": id}))
+            return
+        if upload.done:
+            self.finish_upload(upload)
+        else:
+            self.send(
+                MessageFactory.ok("upload_chunk", {"id": id, "offset": upload.received})
+            )
+
+    def finish_upload(self, upload):
+        del self.transfers[("upload", upload.id)]
+        try:
+            upload.finish()
+        except AttachmentError as e:
+            self.send(MessageFactory.error("upload", str(e), {"id": upload.id}))
+            return
+        self.send(MessageFactory.ok("upload", {"id": upload.id, "complete": True}))
+        attachment = {"id": upload.id, "name": upload.name, "size": upload.size}
+        self.send_message(
+            self.username, upload.to, upload.name, attachment, upload.room
+        )
+
+    def start_download(self, msg: "Message"):
+        id = str(msg.data["id"])
+        if not self.transfer_slot("download", id):
+            return
+        try:
+            download = self.chat_data.attachments.open(id)
+        except AttachmentError as e:
+            self.send(MessageFactory.error("download", str(e), {"id": id}))
+            return
+        if self.transfers is None:
+            self.transfers = {}
+        previous = self.transfers.pop(("download", id), None)
+        if previous:
+            self.chat_data.attachments.close(previous)
+        self.transfers[("download", id)] = download
+        self.send(
+            MessageFactory.ok(
+                "download",
+                {
+                    "id": id,
+                    "size": download.size,
+                    "chunk_size": TRANSFER_CHUNK_SIZE,
+                    "window": TRANSFER_WINDOW,
+                },
+            )
+        )
+        self.pump_download(download)
+
+    def download_ack(self, msg: "Message"):
+        key = ("download", msg.data["id"])
+        download = self.transfers.get(key) if self.transfers else None
+        if download is None:
+            return
+        download.acked = max(
+            download.acked, min(int(msg.data["offset"]), download.sent)
+        )
+        self.pump_download(download)
+
+    def pump_download(self, download):
+        if download.acked == download.size:
+            del self.transfers[("download", download.id)]
+            self.chat_data.attachments.close(download)
+            return
+        # chunks are bulk, room traffic to this connection goes first
+        items = []
+        limit = download.acked + TRANSFER_WINDOW * TRANSFER_CHUNK_SIZE
+        while download.sent < min(download.size, limit):
+            end = min(download.size, download.sent + TRANSFER_CHUNK_SIZE)
+            data = base64.b64encode(download.view[download.sent : end]).decode()
+            chunk = {"id": download.id, "offset": download.sent, "data": data}
+            items.append((BULK, Frame(MessageFactory.ok("download_chunk", chunk))))
+            download.sent = end
+        if items:
+            self.enqueue(items)
+
+    def close_transfers(self):
+        for (kind, _), transfer in (self.transfers or {}).items():
+            if kind == "upload":
+                transfer.abort()
+            else:
+                self.chat_data.attachments.close(transfer)
+        self.transfers = None
 
     def auth(self):
         request = self.recv()
         if request is None:
             return "auth"
-        msg = Message.model_validate(request)
+        msg = parse_message(request)
         print(msg)
         if msg.data is None:
             return "auth"
+        if msg.type == "resume":
+            session = self.chat_data.consume_token(msg.data.get("token"))
+            if session is None:
+                self.send(
+                    MessageFactory.error(
+                        "resume", "Session expired, please login again"
+                    )
+                )
+                return "auth"
+            username, room = session
+            return self.start_session("resume", username, room, msg.data)
+
         username = msg.data["username"]
         password = msg.data["password"]
         if msg.type == "register":
-            if self.chat_data.is_registered(username):
+            if not isinstance(username, str) or len(username) > MAX_NAME_LENGTH:
+                self.send(
+                    MessageFactory.error(
+                        "register",
+                        f"Usernames are at most {MAX_NAME_LENGTH} characters",
+                    )
+                )
+            elif self.chat_data.is_registered(username):
                 self.send(
                     MessageFactory.error(
                         "register", "Username already in use, try another one"
@@ -300,49 +1134,78 @@ class ClientHandler:
             if not self.chat_data.check_password(username, password):
                 self.send(MessageFactory.error("login", "Invalid password"))
                 return "auth"
-            self.send(
-                MessageFactory.ok(
-                    "login",
-                    {"username": f"{username}", "chatroom": "lobby"},
-                    "Login successful",
-                )
-            )
-            self.chat_data.add_online_user(username, self.conn)
-            self.chat_data.enter_room(
-                username, destination="lobby", source=self.chatroom
-            )
-            self.username = username
-            self.chatroom = "lobby"
-            return "lobby"
+            return self.start_session("login", username, options=msg.data)
         else:
             print(f"Invalid command: {msg.to_dict()}")
 
         return "auth"
 
+    def start_session(self, type, username, room="lobby", options=None):
+        username = sys.intern(username)
+        if self.chat_data.capture:
+            self.chat_data.capture.session(self, username)
+        compress = "zlib" in (options or {}).get("compress", [])
+        evicted_from = self.chat_data.add_online_user(username, self)
+        if evicted_from:
+            self.chat_data.presence.forget(username, evicted_from)
+            for room_name in evicted_from:
+                self.notify_room_state(room_name)
+        self.chat_data.enter_room(username, destination="lobby", source=self.chatroom)
+        self.username = username
+        self.chatroom = "lobby"
+        if room != "lobby":
+            try:
+                # resumed sessions go straight back to the room they were in
+                self.chat_data.enter_room(username, destination=room, source="lobby")
+                self.chatroom = room
+            except RoomError:
+                pass
+        self.send(
+            MessageFactory.ok(
+                type,
+                {
+                    "username": username,
+                    "chatroom": self.chatroom,
+                    "token": self.chat_data.issue_token(username, self.chatroom),
+                    "compress": "zlib" if compress else None,
+                },
+                "Login successful",
+            )
+        )
+        # the reply above is the last uncompressed frame
+        self.compress = compress
+        if self.chatroom != "lobby":
+            self.notify_lobby_state()
+        self.send_presence()
+        self.deliver_inbox()
+        return "lobby" if self.chatroom == "lobby" else "chat"
+
     def lobby(self):
-        self.notify_lobby_state()
         request = self.recv()
         if request is None:
             return "lobby"
-        msg = Message.model_validate(request)
+        msg = parse_message(request)
         print(msg)
         if msg.type == "list":
             info = self.chat_data.get_room_info()
             self.send(MessageFactory.ok("list", info))
+        elif msg.type == "stats":
+            self.send_stats()
         elif msg.type == "enter" and msg.data is not None:
             room_name = msg.data["room"]
             try:
                 self.chat_data.enter_room(
                     self.username, destination=room_name, source=self.chatroom
                 )
-                self.chatroom = room_name
-                self.send(
+                self.chatroom = sys.intern(room_name)
+                self.send_page_change(
                     MessageFactory.ok(
                         "enter",
                         data={"username": self.username, "room": self.chatroom},
                         message=f"Welcome to {self.chatroom}",
                     )
                 )
+                self.send_presence()
                 self.notify_lobby_state()
                 return "chat"
             except RoomError as e:
@@ -359,9 +1222,15 @@ class ClientHandler:
                 self.notify_lobby_state()
             except RoomError as e:
                 self.send(MessageFactory.error("create", message=str(e)))
+        elif msg.type == "inbox_ack":
+            self.ack_inbox(msg)
+        elif msg.type == "presence":
+            self.set_status(msg)
         elif msg.type == "logout":
-            self.chat_data.logout(self.username, self.chatroom)
-            self.send(
+            self.chat_data.logout(self.username, self.rooms(), self)
+            self.chat_data.presence.forget(self.username, self.rooms())
+            self.chat_data.revoke_tokens(self.username)
+            self.send_page_change(
                 MessageFactory.ok(
                     "logout", message=f"{self.username} logout successfully"
                 )
@@ -370,84 +1239,314 @@ class ClientHandler:
             self.username = None
             self.chatroom = None
             return "auth"
+        elif msg.type == "download" and msg.data is not None:
+            self.start_download(msg)
+        elif msg.type == "download_ack" and msg.data is not None:
+            self.download_ack(msg)
         else:
             print(f"Invalid command: {msg.to_dict()}")
         return "lobby"
 
     def chat(self):
-        self.notify_room_state(self.chatroom)
         request = self.recv()
         if request is None:
             return "chat"
-        msg = Message.model_validate(request)
-        print(msg)
+        msg = parse_message(request)
+        if msg.type != "upload_chunk":
+            print(msg)
         if msg.type == "exit":
+            # leaving the focused room leaves every joined room as well
+            self.leave_subscriptions()
             try:
                 self.chat_data.enter_room(
                     self.username, destination="lobby", source=self.chatroom
                 )
-                self.send(
+                self.send_page_change(
                     MessageFactory.ok(
                         "exit", message=f"Exit {self.chatroom}, back to lobby"
                     )
                 )
                 self.notify_room_state(self.chatroom)
+                self.chat_data.presence.stop_typing(self.username, self.chatroom)
                 self.chatroom = "lobby"
+                self.send_presence()
                 return "lobby"
             except RoomError as e:
                 self.send(MessageFactory.error("exit", str(e)))
 
             return "lobby"
         elif msg.type == "list":
-            info = self.chat_data.get_room_info(self.chatroom)
-            self.send(MessageFactory.ok("list_room", info))
-        elif msg.type == "msg":
-            if msg.data is None:
-                return
+            room_name = self.target_room(msg)
+            if room_name:
+                info = self.chat_data.get_room_info(room_name)
+                self.send(MessageFactory.ok("list_room", info))
+        elif msg.type == "stats":
+            self.send_stats()
+        elif msg.type == "msg" and msg.data is not None:
+            room_name = self.target_room(msg)
+            if room_name is None:
+                return "chat"
             text = msg.data["text"]
             sender = msg.data["from"]
             receiver = msg.data["to"]
 
-            self.send_message(sender, receiver, text)
+            self.chat_data.presence.stop_typing(self.username, room_name)
+            self.send_message(sender, receiver, text, room_name=room_name)
+        elif msg.type == "typing":
+            room_name = self.target_room(msg)
+            if room_name:
+                self.chat_data.presence.start_typing(self.username, room_name)
+        elif msg.type == "join" and msg.data is not None:
+            self.join(msg.data["room"])
+        elif msg.type == "leave" and msg.data is not None:
+            if msg.data["room"] == self.chatroom and not self.subscriptions:
+                self.send(
+                    MessageFactory.error("leave", "Use exit to leave your last room")
+                )
+            else:
+                self.leave(msg.data["room"])
+        elif msg.type == "focus" and msg.data is not None:
+            self.focus(msg.data["room"])
+        elif msg.type == "presence":
+            self.set_status(msg)
+        elif msg.type == "inbox_ack":
+            self.ack_inbox(msg)
+        elif msg.type == "search" and msg.data is not None:
+            page = max(0, int(msg.data.get("page", 0)))
+            room_name = self.target_room(msg)
+            if room_name:
+                self.search(msg.data.get("query", ""), page, room_name)
+        elif msg.type == "upload" and msg.data is not None:
+            self.start_upload(msg)
+        elif msg.type == "upload_chunk" and msg.data is not None:
+            self.upload_chunk(msg)
+        elif msg.type == "download" and msg.data is not None:
+            self.start_download(msg)
+        elif msg.type == "download_ack" and msg.data is not None:
+            self.download_ack(msg)
         else:
             print(f"Invalid command: {msg.to_dict()}")
         return "chat"
 
 
 def handle_client(conn, addr, chat_data: ChatData):
+    # the handshake runs here, not in the accept loop, so a client that never
+    # sends a ClientHello only holds up its own thread
+    try:
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        conn.do_handshake()
+    except OSError as e:
+        print(f"Handshake with {addr} failed: {e}")
+        conn.close()
+        return
+    print(f"Connected by {addr}")
     handler = ClientHandler(conn, addr, chat_data)
     handler.run()
 
 
+def snapshot_loop(chat_data: ChatData, path, interval, stopping: threading.Event):
+    while not stopping.wait(interval):
+        try:
+            chat_data.snapshot(path)
+        except Exception as e:
+            print(f"Snapshot error: {e}")
+
+
+def drain_connections(chat_data: ChatData, window, timeout):
+    with chat_data.lock:
+        chat_data.closing = True
+        handlers = list(chat_data.connections)
+    # spread the reconnects over the window so the new process is not stampeded
+    random.shuffle(handlers)
+    for i, handler in enumerate(handlers):
+        delay = window * i / len(handlers)
+        handler.send(
+            MessageFactory.ok(
+                "reconnect", {"delay": round(delay, 3)}, "Server restarting"
+            )
+        )
+        # a room worker may still be writing to it, let the reconnect out first
+        handler.outbox.flush(timeout / len(handlers))
+        handler.close()
+
+    deadline = time.monotonic() + timeout
+    while chat_data.connections and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def serve_handoff(
+    server: socket.socket,
+    chat_data: ChatData,
+    stopping: threading.Event,
+    accept_stopped: threading.Event,
+):
+    if os.path.exists(HANDOFF_PATH):
+        os.unlink(HANDOFF_PATH)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as unix:
+        unix.bind(HANDOFF_PATH)
+        unix.listen(1)
+        conn, _ = unix.accept()
+    os.unlink(HANDOFF_PATH)
+
+    with conn:
+        print("Handoff requested, stop accepting")
+        stopping.set()
+        # the accept loop wakes every second; the new process shares the
+        # socket anyway, so a late exit is harmless
+        if not accept_stopped.wait(HANDOFF_GRACE):
+            print("Handoff: accept loop still running, handing over anyway")
+        socket.send_fds(conn, [b"L"], [server.fileno()])
+        drain_connections(chat_data, RECONNECT_WINDOW, DRAIN_TIMEOUT)
+        chat_data.inbox.flush()
+        chat_data.snapshot(SNAPSHOT_PATH)
+        # the new process loads the snapshot once it sees this byte
+        conn.sendall(b"R")
+    print("Handoff done")
+
+
+def take_over_listener() -> tuple[socket.socket, bool]:
+    # returns the listening socket and whether the old server wrote its final
+    # snapshot; without it the new one starts cold
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as unix:
+        # the old side only stops its accept loop before passing the socket
+        unix.settimeout(HANDOFF_GRACE)
+        unix.connect(HANDOFF_PATH)
+        try:
+            _, fds, _, _ = socket.recv_fds(unix, 1, 1)
+        except TimeoutError:
+            fds = []
+        if not fds:
+            raise SystemExit("Handoff: old server did not pass its listening socket")
+        server = socket.socket(fileno=fds[0])
+        # the old side flushes outboxes and waits for handlers, DRAIN_TIMEOUT
+        # each, then flushes the inbox and writes the snapshot
+        unix.settimeout(2 * DRAIN_TIMEOUT + HANDOFF_GRACE)
+        try:
+            drained = unix.recv(1) == b"R"
+        except (TimeoutError, OSError):
+            drained = False
+        if not drained:
+            print("Handoff: old server did not finish draining, starting cold")
+    return server, drained
+
+
+def warm_up(chat_data: ChatData):
+    # runs beside the accept loop, the first login should not pay for imports
+    start = time.perf_counter()
+    chat_data.open_database()
+    parse_message({"type": "warm_up"})
+    print(f"Warm up done in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Python chat room server")
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="restore rooms and resumable sessions from the last snapshot",
+    )
+    parser.add_argument(
+        "--takeover",
+        action="store_true",
+        help="take the listening socket over from a running server (implies --warm)",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="record every connection's inbound frames to PATH for replay.py",
+    )
+    args = parser.parse_args()
+    # a thread per connection, the default 8 MiB stack reservation adds up
+    threading.stack_size(THREAD_STACK_SIZE)
+
     host = os.getenv("HOST")
     port = int(os.getenv("PORT", "65432"))
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((host, port))
-    server.listen()
-    print(f"Server start listening on ({host}, {port})...")
+    if args.takeover:
+        server, drained = take_over_listener()
+        print(f"Server took over listening on {server.getsockname()}...")
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen()
+        print(f"Server start listening on ({host}, {port})...")
+    # wake up regularly so a handoff can stop the accept loop
+    server.settimeout(1.0)
 
     chat_data = ChatData()
+    if args.warm or (args.takeover and drained):
+        start = time.perf_counter()
+        try:
+            restored = chat_data.restore(SNAPSHOT_PATH)
+        except SnapshotError as e:
+            # during a takeover the old server has stopped accepting, a bad
+            # snapshot must not take this one down too
+            print(f"Warm restart: {e}, starting cold")
+        else:
+            if restored:
+                print(
+                    f"Warm restart: {len(chat_data.chatrooms)} rooms, "
+                    f"{len(chat_data.resume_tokens)} sessions restored in "
+                    f"{(time.perf_counter() - start) * 1000:.1f} ms"
+                )
+            else:
+                print(f"Warm restart: no snapshot at {SNAPSHOT_PATH}, starting cold")
+
+    if args.capture:
+        chat_data.capture = Capture(args.capture)
+        print(f"Capturing inbound traffic to {args.capture}")
+
+    threading.Thread(target=warm_up, args=(chat_data,), daemon=True).start()
+    stopping = threading.Event()
+    accept_stopped = threading.Event()
+    threading.Thread(
+        target=snapshot_loop,
+        args=(chat_data, SNAPSHOT_PATH, SNAPSHOT_INTERVAL, stopping),
+        daemon=True,
+    ).start()
+    handoff_thread = threading.Thread(
+        target=serve_handoff,
+        args=(server, chat_data, stopping, accept_stopped),
+        daemon=True,
+    )
+    handoff_thread.start()
 
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     context.load_cert_chain(certfile="server.crt", keyfile="server.key")
 
-    while True:
+    interrupted = False
+    while not stopping.is_set():
         try:
             conn, addr = server.accept()
-            sconn = context.wrap_socket(conn, server_side=True)
-            print(f"Connected by {addr}")
+            sconn = context.wrap_socket(
+                conn, server_side=True, do_handshake_on_connect=False
+            )
             thread = threading.Thread(
                 target=handle_client, args=(sconn, addr, chat_data)
             )
             thread.start()
+        except TimeoutError:
+            continue
         except KeyboardInterrupt:
             print("Server ctrl+c exit")
-            server.close()
+            print(f"Compression: {compression_stats.to_dict()}")
+            print(f"Outbound latency: {outbox_stats.to_dict()}")
+            interrupted = True
+            stopping.set()
+            chat_data.inbox.flush()
+            chat_data.snapshot(SNAPSHOT_PATH)
             break
         except Exception as e:
             print(f"Server unexpected error: {e}")
+    accept_stopped.set()
+    if interrupted:
+        if os.path.exists(HANDOFF_PATH):
+            os.unlink(HANDOFF_PATH)
+    else:
+        handoff_thread.join()
+    server.close()
+    if chat_data.capture:
+        chat_data.capture.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import mmap
+import os
+import struct
+from typing import NamedTuple
+
+
+MAGIC = b"CDS1"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Session(NamedTuple):
+    token_hash: str  # never the token itself, see utils.hash_token
+    username: str
+    room: str
+    expires: float
+
+
+class Snapshot(NamedTuple):
+    rooms: list[str]
+    sessions: list[Session]
+
+
+# Layout (big endian):
+#   MAGIC | u32 room_count | room* | u32 session_count | session*
+#   room    = u16 len + utf-8 name
+#   session = str token_hash | str username | str room | f64 expires
+def _pack_str(buf: bytearray, value: str):
+    raw = value.encode("utf-8")
+    buf += struct.pack(">H", len(raw))
+    buf += raw
+
+
+def _unpack_str(view, offset: int) -> tuple[str, int]:
+    (length,) = struct.unpack_from(">H", view, offset)
+    offset += 2
+    return bytes(view[offset : offset + length]).decode("utf-8"), offset + length
+
+
+def write_snapshot(path: str, snapshot: Snapshot):
+    buf = bytearray(MAGIC)
+    buf += struct.pack(">I", len(snapshot.rooms))
+    for room in snapshot.rooms:
+        _pack_str(buf, room)
+    buf += struct.pack(">I", len(snapshot.sessions))
+    for session in snapshot.sessions:
+        _pack_str(buf, session.token_hash)
+        _pack_str(buf, session.username)
+        _pack_str(buf, session.room)
+        buf += struct.pack(">d", session.expires)
+
+    # write aside and rename, so a crash never leaves a half written snapshot;
+    # owner only, the session list says who is logged in where
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)  # a leftover would keep its old mode
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "wb") as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> Snapshot | None:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        try:
+            if m[:4] != MAGIC:
+                raise SnapshotError(f"{path} is not a chat snapshot")
+            offset = 4
+            (room_count,) = struct.unpack_from(">I", m, offset)
+            offset += 4
+            rooms = []
+            for _ in range(room_count):
+                room, offset = _unpack_str(m, offset)
+                rooms.append(room)
+            (session_count,) = struct.unpack_from(">I", m, offset)
+            offset += 4
+            sessions = []
+            for _ in range(session_count):
+                token_hash, offset = _unpack_str(m, offset)
+                username, offset = _unpack_str(m, offset)
+                room, offset = _unpack_str(m, offset)
+                (expires,) = struct.unpack_from(">d", m, offset)
+                offset += 8
+                sessions.append(Session(token_hash, username, room, expires))
+        except struct.error as e:
+            raise SnapshotError(f"{path} is truncated: {e}") from e
+        except UnicodeDecodeError as e:
+            raise SnapshotError(f"{path} is corrupt: {e}") from e
+    return Snapshot(rooms, sessions)
@@ -1,7 +1,14 @@
 import hashlib
+import json
+import os
 import secrets
-from pydantic import BaseModel
-from typing import Optional, Dict, Any
+import threading
+import time
+import zlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from messages import Message
 
 
 def hash_password(password: str, salt: str) -> str:
@@ -12,11 +19,155 @@ def generate_salt() -> str:
     return secrets.token_hex(16)
 
 
-class Message(BaseModel):
-    type: str
-    status: Optional[str] = None  # "ok" / "error" (response only)
-    message: Optional[str] = None  # human-readable
-    data: Optional[Dict[str, Any]] = None
+def hash_token(token: str) -> str:
+    # resume tokens are random enough that an unsalted hash is fine, only the
+    # hash is kept in memory and in snapshots
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# pydantic is the slowest import after SQLAlchemy, so the Message model is
+# only loaded when the first message is built or parsed
+def make_message(**fields) -> "Message":
+    from messages import Message
+
+    return Message(**fields)
+
+
+def parse_message(request: dict) -> "Message":
+    from messages import Message
+
+    return Message.model_validate(request)
+
+
+# === Framing ===
+# Every frame is a 4-byte big endian length followed by a JSON payload. The
+# high bit of the length marks a zlib-compressed payload; it is only used once
+# both sides agreed on "zlib" at login.
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION = ["zlib"]
+COMPRESS_THRESHOLD = int(os.getenv("COMPRESS_THRESHOLD", "512"))
+# largest payload accepted, on the wire and after decompression
+MAX_FRAME = int(os.getenv("MAX_FRAME", str(16 * 1024 * 1024)))
+
+
+class FrameError(ValueError):
+    pass
+
+
+# Preset dictionary shared by both ends. Frames are compressed independently
+# against it, so a broadcast is compressed once and the same bytes go to every
+# recipient, while short frames still find the protocol boilerplate.
+ZDICT = (
+    b'"text": "", "time": , "more": false, "last_id": , "messages": [{"id": '
+    b'"type": "list", "list_room", "enter", "exit", "status": "error", '
+    b'"message": null, "data": {"lobby": [], "example": [], "username": '
+    b'"chatroom": "lobby", "room": "token": "to": "public", "from": '
+    b'"type": "msg", "status": "ok", "message": null, "data": {"to": "public", '
+    b'"from": "text": "'
+)
+
+
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0  # frames that went through zlib
+        self.skipped = 0  # frames under the threshold
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def record(self, raw_bytes, wire_bytes, cpu_seconds):
+        with self.lock:
+            self.frames += 1
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_seconds += cpu_seconds
+
+    def skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "skipped": self.skipped,
+                "raw_bytes": self.raw_bytes,
+                "wire_bytes": self.wire_bytes,
+                "saved_bytes": self.raw_bytes - self.wire_bytes,
+                "cpu_ms": round(self.cpu_seconds * 1000, 3),
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def _compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=ZDICT)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data: bytes) -> bytes:
+    # bounded, a few KiB of zlib can inflate to gigabytes
+    decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+    try:
+        raw = decompressor.decompress(data, MAX_FRAME)
+    except zlib.error as e:
+        raise FrameError(f"Corrupt compressed frame: {e}") from e
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Frame inflates to more than {MAX_FRAME} bytes")
+    return raw
+
+
+def encode_payload(message_dict) -> bytes:
+    return json.dumps(message_dict).encode("utf-8")
+
+
+def pack_frame(data: bytes, compress=False) -> bytes:
+    if compress and len(data) >= COMPRESS_THRESHOLD:
+        start = time.thread_time()
+        packed = _compress(data)
+        smaller = len(packed) < len(data)
+        # record what is sent, the raw payload when zlib did not help
+        compression_stats.record(
+            len(data),
+            len(packed) if smaller else len(data),
+            time.thread_time() - start,
+        )
+        if smaller:
+            return (len(packed) | COMPRESSED_FLAG).to_bytes(4, "big") + packed
+    elif compress:
+        compression_stats.skip()
+    return len(data).to_bytes(4, "big") + data
+
+
+def encode_frame(message_dict, compress=False) -> bytes:
+    return pack_frame(encode_payload(message_dict), compress)
+
+
+def parse_header(header: bytes) -> tuple[int, bool]:
+    value = int.from_bytes(header, "big")
+    return value & ~COMPRESSED_FLAG, bool(value & COMPRESSED_FLAG)
+
+
+def decode_payload(payload: bytes, compressed: bool) -> dict:
+    if compressed:
+        payload = _decompress(payload)
+    return json.loads(payload.decode("utf-8"))
+
+
+class Frame:
+    # encode a pushed message at most once per variant, however many
+    # recipients it fans out to
+    __slots__ = ("message", "payload", "variants")
+
+    def __init__(self, message_dict):
+        self.message = message_dict
+        self.payload = encode_payload(message_dict)
+        self.variants = {}
 
-    def to_dict(self):
-        return self.model_dump(exclude_unset=True)
+    def encode(self, compress=False) -> bytes:
+        packed = self.variants.get(compress)
+        if packed is None:
+            packed = self.variants[compress] = pack_frame(self.payload, compress)
+        return packed